@@ -1,15 +1,18 @@
 #!/usr/bin/python
 # -*- coding:utf-8 -*-
-import os
 import time
-import random
 import locale
 import math
-import urllib.request
+import hashlib
+from collections import Counter
 from datetime import datetime
 from PIL import Image, ImageDraw, ImageFont, ImageChops
 from weather_lib import Weather
-from moon_lib import phase_of_moon
+from moon_lib import MoonPhaseTable
+from glyph_lib import GlyphAtlas
+from image_lib import ImageLibrary
+from scheduler_lib import Scheduler
+from metrics_lib import METRICS
 try:
     import epd7in5_V2
 except:
@@ -17,6 +20,9 @@ except:
 import sensor_lib
 
 
+MOON_PHASES = MoonPhaseTable(50.24, 24.14)
+
+
 def rotate_point(x, y, centre_x, centre_y, angle):
     angle = math.radians(angle)
     new_x = centre_x + math.cos(angle) * (x - centre_x) - math.sin(angle) * (y - centre_y)
@@ -28,58 +34,132 @@ def rotate_polygon(xy, centre_x, centre_y, angle):
     return [rotate_point(x, y, centre_x, centre_y, angle) for x, y in xy]
 
 
-def parse_range(s):
-    start, *end = s.split('-')
-    end = end[0] if end else start
-    return int(start), int(end) + 1
+def dirty_rects(old, new, width, height, gap=8):
+    # Byte aligned (x0, y0, x1, y1) regions where two packed frames differ,
+    # dirty rows closer than gap are merged into one band
+    stride = width // 8
+    rects = []
+    for y in range(height):
+        row_old = old[y * stride:(y + 1) * stride]
+        row_new = new[y * stride:(y + 1) * stride]
+        if row_old == row_new:
+            continue
+        diff = int.from_bytes(row_old, 'big') ^ int.from_bytes(row_new, 'big')
+        x0 = stride - (diff.bit_length() + 7) // 8
+        x1 = stride - ((diff & -diff).bit_length() - 1) // 8
+        if rects and y - rects[-1][3] < gap:
+            rect = rects[-1]
+            rect[0], rect[2], rect[3] = min(rect[0], x0), max(rect[2], x1), y + 1
+        else:
+            rects.append([x0, y, x1, y + 1])
+    return [(x0 * 8, y0, x1 * 8, y1) for x0, y0, x1, y1 in rects]
 
 
 class FakeEpd:
     init = lambda self: None
     Clear = lambda self: None
     init_fast = lambda self: None
+    init_part = lambda self: None
     sleep = lambda self: None
     display = lambda self, data: None
+    display_Partial = lambda self, data, x0, y0, x1, y1, old_data=None: None
     width = 800
     height = 480
+    busy_time = 0.0
+    busy_cpu = 0.0
 
     def getbuffer(self, data):
         data.save('out.png')
+        return data.tobytes('raw', '1;I')
+
+
+def write_text(img, draw, glyphs, text, font, x, y, w=None, h=None):
+    atlas = glyphs.get(font)
+    if atlas is None or not atlas.supports(text):
+        atlas = None
+    if w or h:
+        left, top, right, bottom = (atlas or font).getbbox(text)
+        if w:
+            x += (w - (right - left)) // 2
+        if h:
+            y += (h - (bottom - top)) // 2
+    if atlas:
+        atlas.draw_text(img, text, x, y)
+    else:
+        draw.text((x, y), text, font=font, fill=0)
+
+
+def render_sprite(name, args, margin=96):
+    # Draw DrawWrapper.<name>(margin, margin, *args) on white and on black background,
+    # pixels that are equal in both are the ones the primitive has drawn
+    layers = []
+    for background in (1, 0):
+        img = Image.new('1', (margin * 2, margin * 2), background)
+        getattr(DrawWrapper(img), name)(margin, margin, *args)
+        layers.append(img)
+    mask = ImageChops.invert(ImageChops.logical_xor(*layers))
+    box = mask.getbbox()
+    if box is None:
+        return None
+    return layers[0].crop(box), mask.crop(box), box[0] - margin, box[1] - margin
 
 
 class DrawWrapper:
-    def __init__(self, img):
+    def __init__(self, img, glyphs=None, sprites=None):
+        self.img = img
         self.draw = ImageDraw.Draw(img)
+        self.glyphs = glyphs or {}
+        self.sprites = sprites
 
     def __getattr__(self, attr):
         return getattr(self.draw, attr)
 
     def write_text(self, text, font, x, y, w=None, h=None):
-        if w or h:
-            left, top, right, bottom = font.getbbox(text)
-            if w:
-                x += (w - (right - left)) // 2
-            if h:
-                y += (h - (bottom - top)) // 2
-        self.draw.text((x, y), text, font=font, fill=0)
+        write_text(self.img, self.draw, self.glyphs, text, font, x, y, w, h)
+
+    def sprite(self, name, x, y, *args):
+        # Paste the cached rendering of <name>(x, y, *args) when a sprite cache is set
+        if self.sprites is None:
+            return False
+        key = (name,) + args
+        if key not in self.sprites:
+            self.sprites[key] = render_sprite(name, args)
+        sprite = self.sprites[key]
+        if sprite:
+            img, mask, dx, dy = sprite
+            self.img.paste(img, (int(x) + dx, int(y) + dy), mask)
+        return True
 
     def write_sun(self, x, y, r):
+        if self.sprite('write_sun', x, y, r):
+            return
         self.draw.circle((x, y), r, width=2)
         ray = ((x - 1, y - r * 1.8), (x + 1, y - r * 1.8), (x + 1, y - r - 3), (x - 1, y - r - 3))
         for angle in range(0, 360, 30):
             xy = rotate_polygon(ray, x, y, angle)
             self.draw.polygon(xy, width=1)
 
+    @staticmethod
+    def moon_phase():
+        phase_angle = MOON_PHASES.phase(datetime.now())
+        return 0 if phase_angle < 90 else 1 if phase_angle < 270 else 2
+
     def write_moon(self, x, y, r):
-        phase_angle = phase_of_moon(50.24, 24.14, datetime.now())
+        self.write_moon_phase(x, y, r, self.moon_phase())
+
+    def write_moon_phase(self, x, y, r, phase):
+        if self.sprite('write_moon_phase', x, y, r, phase):
+            return
         self.draw.circle((x, y), r, fill=0)
-        if phase_angle < 90:
+        if phase == 0:
             self.draw.circle((x-r/2, y), r, fill=1)
-        elif phase_angle < 270:
+        elif phase == 1:
             self.draw.rectangle(((x - r, y - r), (x, y + r)), fill=1)
         self.draw.circle((x, y), r, width=1)
 
     def write_cloud(self, x, y, width, fill=False):
+        if self.sprite('write_cloud', x, y, width, fill):
+            return
         r1 = width / 4
         r2 = width / 6
         r3 = width / 8
@@ -101,13 +181,43 @@ class DrawWrapper:
         self.draw.circle((x, y), r)
         self.draw.polygon(((x - r, y), (x, y - r * 2), (x + r, y)), fill=0)
 
+    def write_rains(self, x, y, r, mask):
+        if self.sprite('write_rains', x, y, r, mask):
+            return
+        if mask & 4:
+            self.write_rain(x, y, r)
+        if mask & 1:
+            self.write_rain(x - r * 4, y, r)
+        if mask & 2:
+            self.write_rain(x + r * 4, y, r)
+        if mask & 8:
+            self.write_rain(x - r * 2, y + r * 4, r)
+        if mask & 16:
+            self.write_rain(x + r * 2, y + r * 4, r)
+
     def write_snow(self, x, y, r):
         ray = ((x, y - r), (x, y + r))
         for angle in range(0, 360, 120):
             xy = rotate_polygon(ray, x, y, angle)
             self.draw.line(xy)
 
+    def write_snows(self, x, y, r, mask):
+        if self.sprite('write_snows', x, y, r, mask):
+            return
+        if mask & 4:
+            self.write_snow(x, y, r)
+        if mask & 1:
+            self.write_snow(x - r * 4, y, r)
+        if mask & 2:
+            self.write_snow(x + r * 4, y, r)
+        if mask & 8:
+            self.write_snow(x - r * 2, y + r * 2, r)
+        if mask & 16:
+            self.write_snow(x + r * 2, y + r * 2, r)
+
     def write_thunder(self, x, y):
+        if self.sprite('write_thunder', x, y):
+            return
         d = 5
         points = (
             (x, y),
@@ -123,6 +233,18 @@ class DrawWrapper:
 
 class App:
     FORECAST_NUM = 9
+    PARTIAL_LIMIT = 30  # full refresh after this many partial ones to clear ghosting
+    PARTIAL_MAX_AREA = 800 * 480 // 2
+    CACHE_DIR = './cache/'
+    WEATHER_HEIGHT = 90
+    SENSOR_PERIOD = 10  # seconds between background sensor reads
+    WEATHER_RETRY_PERIOD = 60  # until the first forecast is published
+    # external temperature sensors as (url, x, y)
+    EXT_SENSORS = [('http://192.168.0.109/temperaturec', 5, 170)]
+    EXT_SENSOR_PERIOD = 30
+    EXT_SENSOR_MAX_AGE = 300  # older values are not shown
+    METRICS_FILE = CACHE_DIR + 'metrics.prom'
+    METRICS_PORT = None  # e.g. 9100 to serve /metrics
 
     def __init__(self):
         try:
@@ -130,27 +252,20 @@ class App:
         except:
             print('Fake EPD is using')
             self.epd = FakeEpd()
+        METRICS.instrument(self.epd, 'getbuffer', 'send_data2', 'ReadBusy', 'sleep')
+        if self.METRICS_PORT:
+            METRICS.serve(self.METRICS_PORT)
         try:
-            self.sensor = sensor_lib.Sensor()
+            sensor = sensor_lib.Sensor()
         except:
             print('Fake Sensor is using')
-            self.sensor = sensor_lib.FakeSensor()
-        self.imgs = {}
-        for root, _, files in os.walk('./img/'):
-            for file in files:
-                if not file.endswith('.png'):
-                    continue
-                img = Image.open(root + '/' + file)
-                m, d, *_ = file.split('_')
-                for i in range(*parse_range(m)):
-                    imgs_m = self.imgs.get(i, {})
-                    if not imgs_m:
-                        self.imgs[i] = imgs_m
-                    for j in range(*parse_range(d)):
-                        imgs_d = imgs_m.get(j, [])
-                        if not imgs_d:
-                            imgs_m[j] = imgs_d
-                        imgs_d.append(img)
+            sensor = sensor_lib.FakeSensor()
+        # sampled by the background scheduler jobs, see schedule()
+        self.sensor = sensor_lib.SensorSampler(sensor, self.SENSOR_PERIOD)
+        self.sensor.sample()
+        self.ext_sensors = sensor_lib.HttpSensorPoller([url for url, _, _ in self.EXT_SENSORS], self.EXT_SENSOR_PERIOD)
+        self.ext_sensors.poll_async()
+        self.imgs = ImageLibrary('./img/')
 
         self.epd.init()
         self.epd.Clear()
@@ -158,164 +273,289 @@ class App:
         self.font64 = ImageFont.truetype('./Academy.ttf', 64)
         self.font128 = ImageFont.truetype('./Academy.ttf', 128)
         self.font256 = ImageFont.truetype('./Academy.ttf', 256)
+        # pre-rendered digits for the text redrawn every minute
+        self.glyphs = {font: GlyphAtlas(font, cache_dir=self.CACHE_DIR)
+                       for font in (self.font16, self.font64, self.font256)}
         self.weather_image = None
+        self.weather_keys = None  # inputs each weather column was rendered from
+        self.weather_version = None
+        self.sprites = {}  # weather icons rendered once, see DrawWrapper.sprite
         self.himage = None
         self.draw = None
-        self.weather = Weather()
-        self.update_weather()
+        self.base_image = None
+        self.sensor_lines = None
+        self.next_buf = None
+        self.next_minute = None  # (year, month, day, hour, minute) next_buf was rendered for
+        self.frame_buf = None
+        self.frame_hash = None
+        self.partial_count = 0
+        self.stats = Counter()
+        self.weather = Weather(cache_dir=self.CACHE_DIR, current=False, forecast_num=self.FORECAST_NUM)
+        try:
+            self.update_weather()
+        except Exception as e:
+            print(f'Weather is not available: {e}')
+            self.weather.update_async()
         self.new_frame()
         self.write_text('ІНІЦІАЛІЗАЦІЯ', self.font64, 0, 0, self.epd.width, self.epd.height)
         self.update()
 
-    def write_all(self):
+    def schedule(self, scheduler, background):
+        # sensor reads go to the background scheduler so they never wait behind a refresh
+        scheduler.add('clock', 60, self.tick)
+        scheduler.add('weather', 3600, self.weather.update_async, offset=60)
+        scheduler.add('housekeeping', 3600, self.housekeeping, offset=1800)
+        background.add('sensor', self.SENSOR_PERIOD, self.sensor.sample, offset=self.SENSOR_PERIOD / 2)
+        background.add('ext_sensors', self.EXT_SENSOR_PERIOD, self.ext_sensors.poll_async, offset=self.EXT_SENSOR_PERIOD / 2)
+        if not self.weather.version:
+            # no forecast yet, e.g. first boot before Wi-Fi is up, don't wait for the hourly slot
+            retry = scheduler.add('weather_retry', self.WEATHER_RETRY_PERIOD, lambda: self.retry_weather(scheduler, retry))
+
+    def retry_weather(self, scheduler, job):
+        if self.weather.version:
+            scheduler.remove(job)
+        elif self.weather.future is None or self.weather.future.done():
+            self.weather.update_async()
+
+    def tick(self):
+        # Push the frame prepared for this minute, then render the next one while idle.
+        # The minute is the one the tick runs in: a catch-up run after an overrun renders
+        # its own minute in write_all(), a run a moment before the boundary the coming one.
+        now = time.time() + 1
+        self.write_all(time.localtime(now))
+        self.prepare(time.localtime((now // 60 + 1) * 60))
+        try:
+            METRICS.write(self.METRICS_FILE)
+        except OSError as e:
+            print(f'Metrics are not written: {e}')
+
+    def housekeeping(self):
+        print(f'Refresh stats: {dict(self.stats)}')
+        if self.weather.cache:
+            print(f'Weather cache stats: {dict(self.weather.cache.stats)}')
+
+    def prepare(self, t):
+        # Render and pack the frame for time t ahead of the minute boundary.
+        # The frame without sensor lines is kept so they can be redrawn late.
+        self.next_minute = None
+        if self.weather.version and self.weather.version != self.weather_version:
+            self.render_weather()
         self.new_frame()
-        self.write_img()
-        self.write_time()
+        self.write_img(t)
+        self.write_time(t)
         self.write_weather()
-        self.write_sensors()
-        self.write_sensors_ext()
+        self.base_image = self.himage.copy()
+        self.sensor_lines = self.read_sensors()
+        self.write_sensors(self.sensor_lines)
+        self.next_buf = self.epd.getbuffer(self.himage)
+        self.next_minute = t[:5]
+
+    def write_all(self, t):
+        if self.next_minute != t[:5]:
+            # prepare() failed or rendered another minute, render this one now
+            self.stats['render_late'] += 1
+            self.prepare(t)
+        lines = self.read_sensors()
+        if lines == self.sensor_lines:
+            self.update(self.next_buf)
+            return
+        self.himage = self.base_image.copy()
+        self.draw = ImageDraw.Draw(self.himage)
+        self.write_sensors(lines)
         self.update()
 
+    @METRICS.stage('new_frame')
     def new_frame(self):
         self.himage = Image.new('1', (self.epd.width, self.epd.height), 255)  # 255: clear the frame
         self.draw = ImageDraw.Draw(self.himage)
 
-    def update(self):
-        self.epd.init_fast()
-        self.epd.display(self.epd.getbuffer(self.himage))
+    @METRICS.stage('update')
+    def update(self, buf=None):
+        if buf is None:
+            buf = self.epd.getbuffer(self.himage)
+        frame_hash = hashlib.blake2b(buf, digest_size=16).digest()
+        if frame_hash == self.frame_hash:
+            # the panel already shows this frame, don't wake it up
+            self.stats['refresh_skipped'] += 1
+            return
+        rects = None
+        if self.frame_buf is not None and self.partial_count < self.PARTIAL_LIMIT:
+            rects = dirty_rects(self.frame_buf, buf, self.epd.width, self.epd.height)
+            if sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in rects) > self.PARTIAL_MAX_AREA:
+                rects = None
+        busy_time, busy_cpu = self.epd.busy_time, self.epd.busy_cpu
+        cpu = time.thread_time()
+        try:
+            self.refresh(buf, rects, self.frame_buf)
+        except TimeoutError as e:
+            # the panel has been reset, the next frame goes out as a full refresh
+            print(f'Refresh failed: {e}')
+            self.stats['refresh_timeout'] += 1
+            self.frame_buf = None
+            self.frame_hash = None
+            return
+        finally:
+            METRICS.observe('refresh_cpu', time.thread_time() - cpu)
+            METRICS.observe('refresh_busy', self.epd.busy_time - busy_time)
+            METRICS.observe('refresh_busy_cpu', self.epd.busy_cpu - busy_cpu)
+        self.frame_buf = buf
+        self.frame_hash = frame_hash
+
+    def refresh(self, buf, rects, old_buf=None):
+        if rects is None:
+            self.epd.init_fast()
+            self.epd.display(buf)
+            self.partial_count = 0
+            self.stats['refresh_full'] += 1
+        else:
+            # sleep() powers the panel off, so the old data RAM is written again from old_buf
+            self.epd.init_part()
+            for rect in rects:
+                self.epd.display_Partial(buf, *rect, old_buf)
+            self.partial_count += 1
+            self.stats['refresh_partial'] += 1
         self.epd.sleep()
 
     def write_text(self, text, font, x, y, w=None, h=None):
-        if w or h:
-            left, top, right, bottom = font.getbbox(text)
-            if w:
-                x += (w - (right - left)) // 2
-            if h:
-                y += (h - (bottom - top)) // 2
-        self.draw.text((x, y), text, font=font, fill=0)
-
-    def write_time(self):
-        text = time.strftime('%H:%M')
+        write_text(self.himage, self.draw, self.glyphs, text, font, x, y, w, h)
+
+    @METRICS.stage('write_time')
+    def write_time(self, t=None):
+        text = time.strftime('%H:%M', t or time.localtime())
         self.write_text(text, self.font256, 0, 90, self.epd.width)
 
-    def write_dow(self):
-        text = time.strftime('%A')
+    @METRICS.stage('write_dow')
+    def write_dow(self, t=None):
+        text = time.strftime('%A', t or time.localtime())
         self.write_text(text, self.font128, 0, 300, self.epd.width)
 
-    def write_img(self):
-        imgs_m = self.imgs.get(time.localtime().tm_mon, self.imgs.get(0, {}))
-        imgs_d = imgs_m.get(time.localtime().tm_mday, imgs_m.get(0, []))
-        if imgs_d:
-            self.himage.paste(random.choice(imgs_d), (0, self.epd.height - 250))
+    @METRICS.stage('write_img')
+    def write_img(self, t=None):
+        img = self.imgs.choice(t or time.localtime())
+        if img:
+            self.himage.paste(img, (0, self.epd.height - 250))
 
     def update_weather(self):
+        self.weather.update()
+        self.render_weather()
+
+    @METRICS.stage('render_weather')
+    def render_weather(self):
         half_period = 90
         width = self.epd.width // self.FORECAST_NUM
-        height = 90
+        with self.weather.lock:
+            sunrise_time = self.weather.sunrise_time.hour * 60 + self.weather.sunrise_time.minute
+            sunset_time = self.weather.sunset_time.hour * 60 + self.weather.sunset_time.minute
+            forecast_list = self.weather.forecast_list[:self.FORECAST_NUM]
+            self.weather_version = self.weather.version
+        moon_phase = DrawWrapper.moon_phase()
+        if self.weather_image is None:
+            self.weather_image = Image.new('1', (self.epd.width, self.WEATHER_HEIGHT), 255)
+            self.weather_keys = [None] * self.FORECAST_NUM
+        for i in range(self.FORECAST_NUM):
+            key = None
+            if i < len(forecast_list):
+                w = forecast_list[i]
+                forecast_time = w.dt.hour * 60 + w.dt.minute
+                is_daytime = sunrise_time <= forecast_time <= sunset_time
+                # night part of the header as (start, end) within the column
+                night = None
+                if forecast_time + half_period <= sunrise_time or forecast_time - half_period >= sunset_time:
+                    night = (0, width)
+                elif forecast_time - half_period < sunrise_time < forecast_time + half_period:
+                    night = (0, (sunrise_time - (forecast_time - half_period)) * width // 180)
+                elif forecast_time - half_period < sunset_time < forecast_time + half_period:
+                    night = ((sunset_time - (forecast_time - half_period)) * width // 180, width)
+                key = (w.dt.strftime('%H:%M'), int(w.temperature), w.sun_size, w.cloud_size,
+                       w.rain_size, w.rain_mask, w.snow_size, w.snow_mask, w.thunder,
+                       is_daytime, None if is_daytime or not w.sun_size else moon_phase, night)
+            if key != self.weather_keys[i]:
+                self.weather_image.paste(self.render_weather_column(key, width), (width * i, 0))
+                self.weather_keys[i] = key
+
+    def render_weather_column(self, key, width):
+        height = self.WEATHER_HEIGHT
         header_offset = 14
         sun_r = 12
         sun_small_r = 10
         moon_r = 20
         moon_small_r = 16
         cloud_offset = header_offset + sun_r * 2 + moon_r
-        self.weather.update()
-        sunrise_time = self.weather.sunrise_time.hour * 60 + self.weather.sunrise_time.minute
-        sunset_time = self.weather.sunset_time.hour * 60 + self.weather.sunset_time.minute
-        self.weather_image = Image.new('1', (self.epd.width, height), 255)
-        draw = DrawWrapper(self.weather_image)
-        night_img = Image.new('1', (self.epd.width, height), 0)
-        night_draw = DrawWrapper(night_img)
-        for i, w in enumerate(self.weather.forecast_list[:self.FORECAST_NUM]):
-            forecast_time = w.dt.hour * 60 + w.dt.minute
-            is_daytime = sunrise_time <= forecast_time <= sunset_time
-            time_str = w.dt.strftime('%H:%M')
-            draw.write_text(time_str, self.font16, width * i, 1, width)
-            draw.write_text(f'{int(w.temperature)}°', self.font16, width * i + 4, header_offset + 2)
-            width_center = width * i + width // 2
-            if w.sun_size == 2:
-                if is_daytime:
-                    draw.write_sun(width * i + width // 2, header_offset + sun_r * 2, sun_r)
-                else:
-                    draw.write_moon(width * i + width // 2, header_offset + sun_r * 2, moon_r)
-            elif w.sun_size == 1:
-                if is_daytime:
-                    draw.write_sun(width * i + width * 2 // 3, header_offset + sun_small_r * 2, sun_small_r)
-                else:
-                    draw.write_moon(width * i + width * 2 // 3, header_offset + sun_small_r * 2, moon_small_r)
-            if w.cloud_size:
-                cloud_width = width * [0, 0.3, 0.5, 0.7, 0.8, 0.8][w.cloud_size]
-                draw.write_cloud(width * i + (width - cloud_width) // 2, cloud_offset, cloud_width, w.cloud_size == 5)
-            if w.rain_mask & 4:
-                draw.write_rain(width_center, cloud_offset + 10, w.rain_size)
-            if w.rain_mask & 1:
-                draw.write_rain(width_center - w.rain_size * 4, cloud_offset + 10, w.rain_size)
-            if w.rain_mask & 2:
-                draw.write_rain(width_center + w.rain_size * 4, cloud_offset + 10, w.rain_size)
-            if w.rain_mask & 8:
-                draw.write_rain(width_center - w.rain_size * 2, cloud_offset + 10 + w.rain_size * 4, w.rain_size)
-            if w.rain_mask & 16:
-                draw.write_rain(width_center + w.rain_size * 2, cloud_offset + 10 + w.rain_size * 4, w.rain_size)
-            if w.snow_mask & 4:
-                draw.write_snow(width_center, cloud_offset + 10, w.snow_size)
-            if w.snow_mask & 1:
-                draw.write_snow(width_center - w.snow_size * 4, cloud_offset + 10, w.snow_size)
-            if w.snow_mask & 2:
-                draw.write_snow(width_center + w.snow_size * 4, cloud_offset + 10, w.snow_size)
-            if w.snow_mask & 8:
-                draw.write_snow(width_center - w.snow_size * 2, cloud_offset + 10 + w.snow_size * 2, w.snow_size)
-            if w.snow_mask & 16:
-                draw.write_snow(width_center + w.snow_size * 2, cloud_offset + 10 + w.snow_size * 2, w.snow_size)
-            if w.thunder:
-                draw.write_thunder(width * i + width // 2, cloud_offset)
-            if forecast_time + half_period <= sunrise_time or forecast_time - half_period >= sunset_time:
-                night_draw.rectangle(((width * i, 0), (width * (i + 1), header_offset - 1)), fill=1)
-            elif forecast_time - half_period < sunrise_time < forecast_time + half_period:
-                part_width = (sunrise_time - (forecast_time - half_period)) * width // 180
-                night_draw.rectangle(((width * i, 0), (width * i + part_width, header_offset - 1)), fill=1)
-            elif forecast_time - half_period < sunset_time < forecast_time + half_period:
-                part_width = (sunset_time - (forecast_time - half_period)) * width // 180
-                night_draw.rectangle(((width * i + part_width, 0), (width * (i + 1), header_offset - 1)), fill=1)
-
-        self.weather_image = ImageChops.logical_xor(self.weather_image, night_img)
-
+        column = Image.new('1', (width, height), 255)
+        if key is None:
+            return column
+        (time_str, temperature, sun_size, cloud_size, rain_size, rain_mask,
+         snow_size, snow_mask, thunder, is_daytime, moon_phase, night) = key
+        draw = DrawWrapper(column, self.glyphs, self.sprites)
+        draw.write_text(time_str, self.font16, 0, 1, width)
+        draw.write_text(f'{temperature}°', self.font16, 4, header_offset + 2)
+        width_center = width // 2
+        if sun_size == 2:
+            if is_daytime:
+                draw.write_sun(width // 2, header_offset + sun_r * 2, sun_r)
+            else:
+                draw.write_moon_phase(width // 2, header_offset + sun_r * 2, moon_r, moon_phase)
+        elif sun_size == 1:
+            if is_daytime:
+                draw.write_sun(width * 2 // 3, header_offset + sun_small_r * 2, sun_small_r)
+            else:
+                draw.write_moon_phase(width * 2 // 3, header_offset + sun_small_r * 2, moon_small_r, moon_phase)
+        if cloud_size:
+            cloud_width = width * [0, 0.3, 0.5, 0.7, 0.8, 0.8][cloud_size]
+            draw.write_cloud((width - cloud_width) // 2, cloud_offset, cloud_width, cloud_size == 5)
+        if rain_mask:
+            draw.write_rains(width_center, cloud_offset + 10, rain_size, rain_mask)
+        if snow_mask:
+            draw.write_snows(width_center, cloud_offset + 10, snow_size, snow_mask)
+        if thunder:
+            draw.write_thunder(width // 2, cloud_offset)
+        if night:
+            night_img = Image.new('1', (width, height), 0)
+            DrawWrapper(night_img).rectangle(((night[0], 0), (night[1], header_offset - 1)), fill=1)
+            column = ImageChops.logical_xor(column, night_img)
+        return column
+
+    @METRICS.stage('write_weather')
     def write_weather(self):
-        self.himage.paste(self.weather_image, (0, 0))
+        if self.weather_image is not None:
+            self.himage.paste(self.weather_image, (0, 0))
 
-    def write_sensors(self):
+    def read_sensors(self):
+        # (text, font, x, y) of every sensor line
         self.sensor.update()
         temperature = self.sensor.get_temperature()
-        text = f'{temperature:.1f}°'
-        self.write_text(text, self.font64, 5, 90)
+        lines = [(f'{temperature:.1f}°', self.font64, 5, 90)]
         humidity = int(self.sensor.get_humidity())
         pressure = int(self.sensor.get_pressure() * 0.750061683)
-        text = f'{humidity}%    {pressure}'
-        self.write_text(text, self.font16, 15, 145)
+        lines.append((f'{humidity}%    {pressure}', self.font16, 15, 145))
+        return lines + self.read_sensors_ext()
 
-    def write_sensors_ext(self):
-        try:
-            with urllib.request.urlopen('http://192.168.0.109/temperaturec', timeout=2) as response:
-                html_content = response.read()
-                temperature = float(html_content)
-                text = f'{temperature:.1f}°'
-                self.write_text(text, self.font64, 5, 170)
-        except urllib.error.URLError as e:
-            print(f"Error accessing the URL: {e.reason}")
-        except Exception as e:
-            print(f"An unexpected error occurred: {e}")
+    def read_sensors_ext(self):
+        lines = []
+        for url, x, y in self.EXT_SENSORS:
+            value = self.ext_sensors.get(url)
+            if value and value[1] <= self.EXT_SENSOR_MAX_AGE:
+                lines.append((f'{value[0]:.1f}°', self.font64, x, y))
+        return lines
+
+    @METRICS.stage('write_sensors')
+    def write_sensors(self, lines):
+        for text, font, x, y in lines:
+            self.write_text(text, font, x, y)
 
 
 if __name__ == "__main__":
     locale.setlocale(locale.LC_ALL, 'uk_UA.UTF-8')
     time.sleep(1)
     app = App()
+    scheduler = Scheduler()
+    background = Scheduler()
     try:
-        while True:
-            curr_sec = time.localtime().tm_sec
-            sleep_sec = 60 - curr_sec
-            time.sleep(sleep_sec)
-            if time.localtime().tm_min == 1:
-                app.update_weather()
-            app.write_all()
+        # scheduled first, so a prepare() that ends after the boundary is caught up at once
+        app.schedule(scheduler, background)
+        background.start()
+        app.prepare(time.localtime((time.time() // 60 + 1) * 60))
+        scheduler.run()
     except KeyboardInterrupt:
         pass
     finally:
@@ -0,0 +1,527 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+import os
+import sys
+import json
+import time
+import ctypes
+import timeit
+import tempfile
+import importlib.util
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image, ImageDraw, ImageFont
+import weather_lib
+
+
+def sample_frame(width=800, height=480):
+    img = Image.new('1', (width, height), 255)
+    draw = ImageDraw.Draw(img)
+    draw.text((0, 90), '12:34', font=ImageFont.truetype('./Academy.ttf', 256), fill=0)
+    draw.rectangle(((0, height - 250), (width // 2, height)), fill=0)
+    return img
+
+
+def legacy_getbuffer(img):
+    buf = bytearray(img.convert('1').tobytes('raw'))
+    for i in range(len(buf)):
+        buf[i] ^= 0xFF
+    return buf
+
+
+def legacy_old_plane(image):
+    image1 = [0xFF] * len(image)
+    for i in range(len(image)):
+        image1[i] = ~image[i]
+    return image1
+
+
+def report(name, func, number):
+    t = min(timeit.repeat(func, number=number, repeat=3)) / number
+    print(f'{name:<32} {t * 1000:9.3f} ms')
+    return t
+
+
+def load_epdconfig_helpers():
+    # A separate epdconfig module loaded with EPD_BOARD_DETECT=0, so the SPI helpers and board
+    # classes run on a dev machine and a later calibration still imports the detected board
+    spec = importlib.util.spec_from_file_location('epdconfig_helpers', './epdconfig.py')
+    module = importlib.util.module_from_spec(spec)
+    detect = os.environ.get('EPD_BOARD_DETECT')
+    os.environ['EPD_BOARD_DETECT'] = '0'
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        if detect is None:
+            del os.environ['EPD_BOARD_DETECT']
+        else:
+            os.environ['EPD_BOARD_DETECT'] = detect
+    return module
+
+
+def load_epd_driver():
+    # A separate epd7in5_V2 over load_epdconfig_helpers() with the Raspberry Pi pins, so the
+    # pure PIL paths (getbuffer, the 4 gray planes) run on a dev machine
+    epdconfig = load_epdconfig_helpers()
+    for name in ('RST_PIN', 'DC_PIN', 'CS_PIN', 'BUSY_PIN', 'PWR_PIN'):
+        setattr(epdconfig, name, getattr(epdconfig.RaspberryPi, name))
+    spec = importlib.util.spec_from_file_location('epd7in5_V2_helpers', './epd7in5_V2.py')
+    module = importlib.util.module_from_spec(spec)
+    imported = sys.modules.get('epdconfig')
+    sys.modules['epdconfig'] = epdconfig
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        if imported is None:
+            del sys.modules['epdconfig']
+        else:
+            sys.modules['epdconfig'] = imported
+    return module
+
+
+def bench_getbuffer(number=20):
+    epd7in5_V2 = load_epd_driver()
+    epd = epd7in5_V2.EPD()
+    img = sample_frame()
+    img_rotated = sample_frame(epd.height, epd.width)
+    assert epd.getbuffer(img) == legacy_getbuffer(img)
+    assert epd.getbuffer(img_rotated) == legacy_getbuffer(img_rotated.rotate(90, expand=True))
+    legacy = report('getbuffer (python loop)', lambda: legacy_getbuffer(img), number)
+    packed = report('getbuffer (packed)', lambda: epd.getbuffer(img), number)
+    report('getbuffer rotated (packed)', lambda: epd.getbuffer(img_rotated), number)
+    print(f'speedup x{legacy / packed:.1f}')
+
+
+def bench_old_plane(number=20):
+    epd7in5_V2 = load_epd_driver()
+    epd = epd7in5_V2.EPD()
+    buf = epd.getbuffer(sample_frame())
+    assert bytes(b & 0xFF for b in legacy_old_plane(buf)) == buf.translate(epd7in5_V2.INVERT_TABLE)
+    legacy = report('old plane (python list)', lambda: legacy_old_plane(buf), number)
+    packed = report('old plane (translate)', lambda: buf.translate(epd7in5_V2.INVERT_TABLE), number)
+    print(f'speedup x{legacy / packed:.1f}')
+
+
+class LegacyForecast:
+    def __init__(self, data):
+        self.dt = weather_lib.utc_to_timezone(data['dt'])
+        self.temperature = data['main']['temp']
+        weather_list = data['weather']
+        self.weather_ids = {w['id'] for w in weather_list}
+        self.weather_icons = {w['icon'] for w in weather_list}
+        self.snow_size = 0
+        self.snow_mask = 0
+        self.rain_size = 0
+        self.rain_mask = 0
+        self.thunder = False
+        self.cloud_size = 0
+        self.sun_size = 0
+        rain_snow = self.weather_ids & set(weather_lib.RAIN_SNOW_SIZE.keys())
+        if rain_snow:
+            weather_id = next(iter(rain_snow))
+            self.snow_size, self.snow_mask, self.rain_size, self.rain_mask, self.thunder = weather_lib.RAIN_SNOW_SIZE[weather_id]
+            self.cloud_size = 5
+        cloud_sun = self.weather_ids & set(weather_lib.CLOUD_SUN_SIZE.keys())
+        if cloud_sun:
+            weather_id = next(iter(cloud_sun))
+            self.cloud_size, self.sun_size = weather_lib.CLOUD_SUN_SIZE[weather_id]
+
+
+def bench_forecast(number=200, path='./forecast_query.json'):
+    try:
+        with open(path) as f:
+            forecast_query = json.load(f)
+    except OSError:
+        print(f'{path} is missing, save a forecast response to run this benchmark')
+        return
+    fields = ('snow_size', 'snow_mask', 'rain_size', 'rain_mask', 'thunder', 'cloud_size', 'sun_size')
+    for data in forecast_query['list']:
+        new, old = weather_lib.Forecast(data), LegacyForecast(data)
+        assert all(getattr(new, field) == getattr(old, field) for field in fields)
+    legacy = report('Forecast parse (sets)', lambda: [LegacyForecast(f) for f in forecast_query['list']], number)
+    table = report('Forecast parse (table)', lambda: [weather_lib.Forecast(f) for f in forecast_query['list']], number)
+    print(f'speedup x{legacy / table:.1f}')
+    old, new = LegacyForecast(forecast_query['list'][0]), weather_lib.Forecast(forecast_query['list'][0])
+    print(f'Forecast size {sys.getsizeof(old) + sys.getsizeof(old.__dict__) + sys.getsizeof(old.weather_ids)} -> '
+          f'{sys.getsizeof(new) + sys.getsizeof(new.weather_ids)} bytes')
+
+
+class FakeHttpServer:
+    # Local HTTP/1.1 server, routes map a path to handler(request) -> (status, headers, body, delay)
+    def __init__(self, routes, idle_timeout=None):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            timeout = idle_timeout  # a kept-alive connection is closed after this idle time
+
+            def do_GET(self):
+                server.requests.append(self.path)
+                status, headers, body, delay = routes[self.path](self)
+                time.sleep(delay)
+                try:
+                    self.send_response(status)
+                    for name, value in headers.items():
+                        self.send_header(name, value)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except OSError:
+                    pass  # the client has given up
+
+            def log_message(self, format, *args):
+                pass
+
+        self.requests = []
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}'
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+FAKE_FORECAST = json.dumps({'cod': '200', 'list': [
+    {'dt': 1700000000 + i * 10800, 'main': {'temp': i}, 'weather': [{'id': 800, 'icon': '01d'}]} for i in range(40)]})
+FAKE_WEATHER = json.dumps({'dt': 1700000000, 'main': {'humidity': 50, 'pressure': 1000},
+                           'sys': {'sunrise': 1700000000, 'sunset': 1700030000}})
+
+
+def check_weather_http():
+    # request_text, ResponseCache and Weather.update against a local fake API
+    calls = {'flaky': 0}
+
+    def flaky(request):
+        calls['flaky'] += 1
+        return (500 if calls['flaky'] == 1 else 200), {}, b'{}', 0
+
+    def etag(request):
+        if request.headers.get('If-None-Match') == '"v1"':
+            return 304, {'ETag': '"v1"'}, b'', 0
+        return 200, {'ETag': '"v1"'}, b'{"v": 1}', 0
+
+    server = FakeHttpServer({
+        '/ok': lambda request: (200, {}, b'{}', 0),
+        '/slow': lambda request: (200, {}, b'{}', 0.5),
+        '/flaky': flaky,
+        '/etag': etag,
+        '/forecast': lambda request: (200, {}, FAKE_FORECAST.encode(), 0.3),
+        '/weather': lambda request: (200, {}, FAKE_WEATHER.encode(), 0.3),
+        '/malformed': lambda request: (200, {}, b'{"cod": "200", "list": [{"dt": 1700000000}]}', 0),
+        '/error': lambda request: (200, {}, b'{"cod": "404", "message": "city not found"}', 0),
+    })
+    fast = dict(timeout=0.2, retries=2, backoff=0.05)
+    try:
+        report('request_text ok', lambda: weather_lib.request_text(server.url + '/ok', **fast), 10)
+        assert weather_lib.request_text(server.url + '/flaky', **fast)[0] == '{}' and calls['flaky'] == 2
+        print('request_text retries a 500 once and succeeds')
+
+        start = time.perf_counter()
+        try:
+            weather_lib.request_text(server.url + '/slow', **fast)
+            raise AssertionError('slow response did not time out')
+        except OSError as e:
+            print(f'request_text slow server gives up after {time.perf_counter() - start:.2f} s: {e}')
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = weather_lib.ResponseCache(tmp, ttl={})
+            url = server.url + '/etag'
+            assert cache.get(url) == '{"v": 1}'
+            # without a ttl the entry is stale at once, served and revalidated in background
+            assert cache.get(url) == '{"v": 1}'
+            future = cache.pending.get(url)
+            if future:
+                future.result()
+            assert cache.stats['miss'] == 1 and cache.stats['stale'] == 1 and cache.stats['not_modified'] == 1, cache.stats
+            print(f'ResponseCache revalidates with ETag: {dict(cache.stats)}')
+
+            # past max_stale the entry is revalidated before it is returned
+            cache = weather_lib.ResponseCache(tmp, ttl={}, max_stale={url: 0})
+            assert cache.get(url) == '{"v": 1}' and not cache.pending
+            assert cache.stats['expired'] == 1 and cache.stats['stale'] == 0, cache.stats
+            print(f'ResponseCache waits for an expired entry: {dict(cache.stats)}')
+
+        urls = weather_lib.FORECAST_URL, weather_lib.WEATHER_URL
+        weather_lib.FORECAST_URL, weather_lib.WEATHER_URL = server.url + '/forecast', server.url + '/weather'
+        try:
+            weather = weather_lib.Weather()
+            start = time.perf_counter()
+            weather.update()
+            elapsed = time.perf_counter() - start
+            assert weather.version == 1 and weather.forecast_list[0].temperature == 0 and weather.humidity_now == 50
+            assert elapsed < 0.55, 'requests are not concurrent'
+            print(f'Weather.update with two 0.3 s requests takes {elapsed:.2f} s')
+            forecast_list = weather.forecast_list
+            for path in ('/malformed', '/error'):
+                weather_lib.FORECAST_URL = server.url + path
+                try:
+                    weather.update()
+                    raise AssertionError(f'{path} forecast is published')
+                except (KeyError, ValueError) as e:
+                    assert weather.version == 1 and weather.forecast_list is forecast_list
+                    print(f'Weather.update {path} fails with {e!r} and keeps the old data')
+        finally:
+            weather_lib.FORECAST_URL, weather_lib.WEATHER_URL = urls
+    finally:
+        server.close()
+
+
+def check_http_sensor(polls=6, period=1.0, idle_timeout=0.5):
+    # HttpSensorPoller against a stand-in sensor that drops idle kept-alive connections
+    import sensor_lib
+    server = FakeHttpServer({'/temperaturec': lambda request: (200, {}, b'21.5', 0)}, idle_timeout)
+    url = server.url + '/temperaturec'
+    poller = sensor_lib.HttpSensorPoller([url], timeout=1)
+    try:
+        for i in range(polls):
+            poller.values.clear()
+            start = time.perf_counter()
+            poller.poll(url)
+            assert poller.get(url)[0] == 21.5, f'poll {i} failed'
+            print(f'poll {i}: {(time.perf_counter() - start) * 1000:.2f} ms')
+            time.sleep(period)
+        # polls within the idle timeout share the connection
+        poller.poll(url)
+        poller.poll(url)
+        assert len(server.requests) == polls + 2
+        print(f'{polls + 2} polls, {poller.reconnects} reconnects after an idle close')
+    finally:
+        server.close()
+
+
+class RecordingEpd:
+    # Stands in for the panel in App.update(): keeps the refresh calls, packs like getbuffer()
+    width = 800
+    height = 480
+    busy_time = 0.0
+    busy_cpu = 0.0
+
+    def __init__(self):
+        self.calls = []
+
+    def getbuffer(self, image):
+        return image.tobytes('raw', '1;I')
+
+    def __getattr__(self, name):
+        if name not in ('init_fast', 'init_part', 'display', 'display_Partial', 'sleep'):
+            raise AttributeError(name)
+        return lambda *args: self.calls.append(name)
+
+
+def check_partial_refresh(month=7, day=15):
+    # Two consecutive minutes with the real img/ library: the background stays and the
+    # second minute goes out as a partial refresh
+    import app
+    import sensor_lib
+    epd = RecordingEpd()
+    a = app.App.__new__(app.App)
+    a.epd = epd
+    a.imgs = app.ImageLibrary('./img/')
+    a.font16 = ImageFont.truetype('./Academy.ttf', 16)
+    a.font64 = ImageFont.truetype('./Academy.ttf', 64)
+    a.font128 = ImageFont.truetype('./Academy.ttf', 128)
+    a.font256 = ImageFont.truetype('./Academy.ttf', 256)
+    a.glyphs = {}
+    a.sensor = sensor_lib.FakeSensor()
+    a.EXT_SENSORS = []
+    a.weather = weather_lib.Weather(current=False)
+    a.weather_version = None
+    a.weather_image = None
+    a.frame_buf = None
+    a.frame_hash = None
+    a.partial_count = 0
+    a.stats = app.Counter()
+    print(f'{len(a.imgs.day_paths(month, day))} background images for {month}/{day}')
+    for minute in (0, 1):
+        t = time.struct_time((2026, month, day, 10, minute, 0, 0, 0, -1))
+        t = time.localtime(time.mktime(t))
+        a.prepare(t)
+        a.write_all(t)
+    assert epd.calls.count('display') == 1 and epd.calls.count('display_Partial') >= 1, epd.calls
+    assert a.stats['refresh_partial'] == 1, dict(a.stats)
+    print(f'App.update refreshes {dict(a.stats)}')
+
+
+def legacy_getbuffer_4gray(image, width=800, height=480):
+    buf = [0xFF] * (int(width / 4) * height)
+    image_monocolor = image.convert('L')
+    pixels = image_monocolor.load()
+    i = 0
+    for y in range(height):
+        for x in range(width):
+            if pixels[x, y] == 0xC0:
+                pixels[x, y] = 0x80
+            elif pixels[x, y] == 0x80:
+                pixels[x, y] = 0x40
+            i = i + 1
+            if i % 4 == 0:
+                buf[int((x + (y * width)) / 4)] = ((pixels[x-3, y] & 0xc0) | (pixels[x-2, y] & 0xc0) >> 2 | (pixels[x-1, y] & 0xc0) >> 4 | (pixels[x, y] & 0xc0) >> 6)
+    return buf
+
+
+def legacy_plane_4gray(image, bits):
+    # bits: plane bit for the codes 0xC0, 0x00, 0x80 and 0x40, one send_data() per byte
+    plane = []
+    for i in range(0, 48000):
+        temp3 = 0
+        for j in range(0, 2):
+            temp1 = image[i*2+j]
+            for k in range(0, 4):
+                temp3 = temp3 << 1 | bits[{0xC0: 0, 0x00: 1, 0x80: 2, 0x40: 3}[temp1 & 0xC0]]
+                temp1 <<= 2
+        plane.append(temp3)
+    return plane
+
+
+def sample_frame_4gray(width=800, height=480):
+    img = Image.new('L', (width, height), 0xFF)
+    draw = ImageDraw.Draw(img)
+    for i, gray in enumerate((0xFF, 0xC0, 0x80, 0x00)):
+        draw.rectangle(((i * width // 4, 0), ((i + 1) * width // 4, height)), fill=gray)
+    draw.text((0, 90), '12:34', font=ImageFont.truetype('./Academy.ttf', 256), fill=0x80)
+    return img
+
+
+def bench_4gray(number=5):
+    epd7in5_V2 = load_epd_driver()
+    epd = epd7in5_V2.EPD()
+    img = sample_frame_4gray()
+    buf = epd.getbuffer_4Gray(img)
+    assert buf == bytes(legacy_getbuffer_4gray(img))
+    planes = Image.frombytes('L', (epd.width, epd.height), buf, 'raw', 'L;2')
+    assert planes.point(epd7in5_V2.GRAY4_OLD_PLANE, '1').tobytes() == bytes(legacy_plane_4gray(buf, (0, 1, 1, 0)))
+    assert planes.point(epd7in5_V2.GRAY4_NEW_PLANE, '1').tobytes() == bytes(legacy_plane_4gray(buf, (0, 1, 0, 1)))
+    legacy = report('getbuffer_4Gray (python loop)', lambda: legacy_getbuffer_4gray(img), 1)
+    packed = report('getbuffer_4Gray (packed)', lambda: epd.getbuffer_4Gray(img), number)
+    print(f'speedup x{legacy / packed:.1f}')
+    legacy = report('4 gray planes (python loop)', lambda: legacy_plane_4gray(buf, (0, 1, 1, 0)), 1)
+    packed = report('4 gray planes (packed)', lambda: Image.frombytes('L', (epd.width, epd.height), buf, 'raw', 'L;2').point(
+        epd7in5_V2.GRAY4_OLD_PLANE, '1').tobytes(), number)
+    print(f'speedup x{legacy / packed:.1f}')
+
+
+SPI_SPEEDS = (2000000, 4000000, 8000000, 16000000, 24000000, 32000000)
+
+
+class RecordingSpi:
+    # Stands in for spidev.SpiDev: keeps the transfers and takes their wire time
+    def __init__(self, bufsiz=4096, max_speed_hz=4000000):
+        self.bufsiz = bufsiz
+        self.max_speed_hz = max_speed_hz
+        self.transfers = []
+
+    def writebytes2(self, data):
+        if len(data) > self.bufsiz:
+            raise OverflowError(f'{len(data)} bytes transfer, bufsiz is {self.bufsiz}')
+        self.transfers.append(bytes(data))
+        time.sleep(len(data) * 8 / self.max_speed_hz)
+
+
+def bench_spi(number=3, speeds=SPI_SPEEDS):
+    # Throughput of the chunked transfer layer per clock speed against a recording fake device
+    epdconfig = load_epdconfig_helpers()
+    buf = legacy_getbuffer(sample_frame())
+    bufsiz = epdconfig.spi_bufsiz()
+    spi = RecordingSpi(bufsiz)
+    epdconfig.spi_write_chunked(spi.writebytes2, list(buf), bufsiz)
+    assert b''.join(spi.transfers) == buf
+    for speed in speeds:
+        spi.max_speed_hz = speed
+        t = report(f'frame at {speed / 1e6:g} MHz', lambda: epdconfig.spi_write_chunked(spi.writebytes2, buf, bufsiz), number)
+        wire = len(buf) * 8 / speed
+        print(f'{"":<32} {len(buf) / t / 1e6:9.3f} MB/s, {wire / t * 100:.0f}% of the wire time')
+
+
+def calibrate_spi(number=3, speeds=SPI_SPEEDS):
+    # Measures the real panel at each clock speed and shows the test frame sent at it,
+    # pick the fastest one without artifacts and set EPD_SPI_HZ to it
+    import epd7in5_V2
+    epdconfig = epd7in5_V2.epdconfig
+    if not hasattr(epdconfig, 'spi_set_speed'):
+        print('The SPI clock of this board is not adjustable')
+        return
+    epd = epd7in5_V2.EPD()
+    buf = epd.getbuffer(sample_frame())
+    # init_fast() opens the SPI device, so it runs once and only the clock changes per speed
+    if epd.init_fast() != 0:
+        print('The panel is not initialized')
+        return
+    try:
+        for speed in speeds:
+            epdconfig.spi_set_speed(speed)
+
+            def transfer():
+                epd.send_command(0x13)
+                epd.send_data2(buf)
+            t = report(f'frame at {speed / 1e6:g} MHz', transfer, number)
+            print(f'{"":<32} {len(buf) / t / 1e6:9.3f} MB/s')
+            epd.display(buf)
+            input('Check the panel and press Enter')
+    finally:
+        epd.sleep()
+
+
+STUB_SOFTWARE_SPI = '''
+#include <stdint.h>
+uint32_t checksum;
+uint8_t SYSFS_software_spi_transfer(uint8_t value) { checksum = checksum * 31 + value; return 0; }
+'''
+
+
+def bench_jetson_spi(number=3):
+    # JetsonNano.spi_writebyte2 against a stub sysfs_software_spi.so, per byte and bulk
+    epdconfig = load_epdconfig_helpers()
+    buf = legacy_getbuffer(sample_frame())
+    with tempfile.TemporaryDirectory() as tmp:
+        stub_path = os.path.join(tmp, 'sysfs_software_spi.so')
+        bulk_path = os.path.join(tmp, 'sysfs_software_spi_bulk.so')
+        with open(os.path.join(tmp, 'stub.c'), 'w') as f:
+            f.write(STUB_SOFTWARE_SPI)
+        try:
+            subprocess.run(['gcc', '-O2', '-shared', '-fPIC', '-o', stub_path, os.path.join(tmp, 'stub.c')], check=True)
+            subprocess.run(['gcc', '-O2', '-shared', '-fPIC', '-o', bulk_path, './sysfs_software_spi_bulk.c'], check=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f'Stub libraries are not built: {e}')
+            return
+        jetson = epdconfig.JetsonNano.__new__(epdconfig.JetsonNano)
+        jetson.SPI = ctypes.CDLL(stub_path, mode=ctypes.RTLD_GLOBAL)
+        checksum = ctypes.c_uint32.in_dll(jetson.SPI, 'checksum')
+        results = []
+        for name, bulk in (('per byte', None), ('bulk', epdconfig.load_spi_bulk(bulk_path))):
+            jetson.SPI_BULK = bulk
+            checksum.value = 0
+            jetson.spi_writebyte2(buf)
+            results.append(checksum.value)
+            t = report(f'jetson frame ({name})', lambda: jetson.spi_writebyte2(buf), number)
+            print(f'{"":<32} {t / len(buf) * 1e9:9.1f} ns/byte')
+        assert results[0] == results[1]
+
+
+BENCHMARKS = {
+    'getbuffer': bench_getbuffer,
+    'old_plane': bench_old_plane,
+    'forecast': bench_forecast,
+    'spi': bench_spi,
+    'jetson_spi': bench_jetson_spi,
+    '4gray': bench_4gray,
+}
+
+# checks against local stand-ins, only run when named
+CHECKS = {
+    'weather_http': check_weather_http,
+    'http_sensor': check_http_sensor,
+    'partial_refresh': check_partial_refresh,
+}
+
+# need the panel, only run when named
+CALIBRATIONS = {
+    'calibrate_spi': calibrate_spi,
+}
+
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        (BENCHMARKS.get(name) or CHECKS.get(name) or CALIBRATIONS[name])()
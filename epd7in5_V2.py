@@ -28,8 +28,10 @@
 #
 
 
+import time
 import logging
 import epdconfig
+from PIL import Image
 
 # Display resolution
 EPD_WIDTH       = 800
@@ -40,6 +42,80 @@ GRAY2  = 0xC0
 GRAY3  = 0x80 #gray
 GRAY4  = 0x00 #Blackest
 
+# Lookup table for bytes.translate() that flips every bit of a byte
+INVERT_TABLE = bytes(0xFF ^ i for i in range(256))
+
+# Busy wait limits in seconds, a full refresh takes about 4 s
+BUSY_TIMEOUT   = 30
+BUSY_POLL_MIN  = 0.001
+BUSY_POLL_MAX  = 0.05
+
+POWER_ON = 0x04  # waits for the busy pin in send_sequence()
+
+# Init routines as (command, parameters), each command is sent with one bulk data write
+INIT = (
+    (0x06, b'\x17\x17\x28\x17'),    # btst, if an exception is displayed, try 0x38 as the third byte
+    (0x01, b'\x07\x07\x28\x17'),    # POWER SETTING: VGH=20V,VGL=-20V, VDH=15V, VDL=-15V
+    (POWER_ON, b''),
+    (0x00, b'\x1f'),                # PANNEL SETTING: KW-3f   KWR-2F   BWROTP 0f   BWOTP 1f
+    (0x61, b'\x03\x20\x01\xe0'),    # tres: source 800, gate 480
+    (0x15, b'\x00'),
+    # If the screen appears gray, use 0x50: 0x10 0x17 and 0x52: 0x03
+    (0x50, b'\x10\x07'),
+    (0x60, b'\x22'),                # TCON SETTING
+)
+
+INIT_FAST = (
+    (0x00, b'\x1f'),                # PANNEL SETTING
+    # If the screen appears gray, use 0x50: 0x10 0x17 and 0x52: 0x03
+    (0x50, b'\x10\x07'),
+    (POWER_ON, b''),
+    (0x06, b'\x27\x27\x18\x17'),    # Enhanced display drive: Booster Soft Start
+    (0xE0, b'\x02'),
+    (0xE5, b'\x5a'),
+)
+
+INIT_PART = (
+    (0x00, b'\x1f'),                # PANNEL SETTING
+    (POWER_ON, b''),
+    (0xE0, b'\x02'),
+    (0xE5, b'\x6e'),
+)
+
+INIT_4GRAY = (
+    (0x00, b'\x1f'),                # PANNEL SETTING
+    (0x50, b'\x10\x07'),
+    (POWER_ON, b''),
+    (0x06, b'\x27\x27\x18\x17'),    # Enhanced display drive: Booster Soft Start
+    (0xE0, b'\x02'),
+    (0xE5, b'\x5f'),
+)
+
+# 4 gray: L value -> 2 bit pixel code, 0xC0 and 0x80 are remapped to the next darker level
+GRAY4_CODES = [(0x80 if v == 0xC0 else 0x40 if v == 0x80 else v) >> 6 for v in range(256)]
+GRAY4_HIGH_BIT = [255 * (code >> 1) for code in GRAY4_CODES]
+GRAY4_LOW_BIT = [255 * (code & 1) for code in GRAY4_CODES]
+# 'L;2' unpacks codes 0-3 to 0, 85, 170, 255, these set the bits of the two planes
+GRAY4_OLD_PLANE = [255 if v in (0, 170) else 0 for v in range(256)]
+GRAY4_NEW_PLANE = [255 if v in (0, 85) else 0 for v in range(256)]
+
+
+def spread_nibble(n):
+    # bits 3-0 to bits 6, 4, 2, 0
+    return (n & 8) << 3 | (n & 4) << 2 | (n & 2) << 1 | (n & 1)
+
+
+SPREAD_HIGH_NIBBLE = bytes(spread_nibble(i >> 4) for i in range(256))
+SPREAD_LOW_NIBBLE = bytes(spread_nibble(i & 15) for i in range(256))
+
+
+def spread_bits(data):
+    # Every bit of data followed by a zero bit, the result is twice as long
+    spread = bytearray(len(data) * 2)
+    spread[0::2] = data.translate(SPREAD_HIGH_NIBBLE)
+    spread[1::2] = data.translate(SPREAD_LOW_NIBBLE)
+    return spread
+
 logger = logging.getLogger(__name__)
 
 class EPD:
@@ -54,6 +130,13 @@ class EPD:
         self.GRAY2  = GRAY2
         self.GRAY3  = GRAY3 #gray
         self.GRAY4  = GRAY4 #Blackest
+        # Constant planes shared by Clear() and getbuffer(), allocated once
+        self.buffer_size = int(self.width / 8) * self.height
+        self.white_buffer = b'\xff' * self.buffer_size
+        self.black_buffer = bytes(self.buffer_size)
+        # Totals of ReadBusy() wall and CPU time, read them before and after a refresh
+        self.busy_time = 0.0
+        self.busy_cpu = 0.0
     
     # Hardware reset
     def reset(self):
@@ -76,232 +159,127 @@ class EPD:
         epdconfig.spi_writebyte([data])
         epdconfig.digital_write(self.cs_pin, 1)
 
+    # Command followed by its parameters in one SPI write
+    def send_command_data(self, command, data):
+        epdconfig.digital_write(self.dc_pin, 0)
+        epdconfig.digital_write(self.cs_pin, 0)
+        epdconfig.spi_writebyte([command])
+        if data:
+            epdconfig.digital_write(self.dc_pin, 1)
+            epdconfig.spi_writebyte2(data)
+        epdconfig.digital_write(self.cs_pin, 1)
+
     def send_data2(self, data):
         epdconfig.digital_write(self.dc_pin, 1)
         epdconfig.digital_write(self.cs_pin, 0)
-        epdconfig.SPI.writebytes2(data)
+        epdconfig.spi_writebyte2(data)
         epdconfig.digital_write(self.cs_pin, 1)
 
-    def ReadBusy(self):
+    def ReadBusy(self, timeout=BUSY_TIMEOUT):
         logger.debug("e-Paper busy")
+        start = time.monotonic()
+        start_cpu = time.thread_time()
         self.send_command(0x71)
-        busy = epdconfig.digital_read(self.busy_pin)
-        while(busy == 0):
-            self.send_command(0x71)
-            busy = epdconfig.digital_read(self.busy_pin)
+        ready = self.wait_idle(timeout)
+        self.busy_time += time.monotonic() - start
+        self.busy_cpu += time.thread_time() - start_cpu
+        if not ready:
+            # A wedged controller only comes back after a hardware reset. Power and SPI are
+            # released too, so the next init opens them again like after sleep()
+            logger.error("e-Paper busy timeout")
+            self.reset()
+            epdconfig.module_exit()
+            raise TimeoutError("e-Paper is busy for more than %.1f s" % timeout)
         epdconfig.delay_ms(20)
         logger.debug("e-Paper busy release")
+
+    def wait_idle(self, timeout):
+        # BUSY_PIN goes high when the panel is idle. Backends that can wait for the
+        # edge sleep in the GPIO library, the rest are polled with growing delays.
+        wait = getattr(epdconfig, 'digital_wait', None)
+        if wait:
+            ready = wait(self.busy_pin, 1, timeout)
+            if ready is not None:
+                return ready
+        deadline = time.monotonic() + timeout
+        delay = BUSY_POLL_MIN
+        while epdconfig.digital_read(self.busy_pin) == 0:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, BUSY_POLL_MAX)
+            self.send_command(0x71)
+        return True
         
-    def init(self):
+    def send_sequence(self, sequence):
+        for command, data in sequence:
+            self.send_command_data(command, data)
+            if command == POWER_ON:
+                epdconfig.delay_ms(100)
+                self.ReadBusy()        #waiting for the electronic paper IC to release the idle signal
+
+    def init_sequence(self, sequence):
         if (epdconfig.module_init() != 0):
             return -1
         # EPD hardware init start
         self.reset()
-        
-        self.send_command(0x06)     # btst
-        self.send_data(0x17)
-        self.send_data(0x17)
-        self.send_data(0x28)        # If an exception is displayed, try using 0x38
-        self.send_data(0x17)
-        
-        self.send_command(0x01)			#POWER SETTING
-        self.send_data(0x07)
-        self.send_data(0x07)    #VGH=20V,VGL=-20V
-        self.send_data(0x28)		#VDH=15V
-        self.send_data(0x17)		#VDL=-15V
-
-        self.send_command(0x04) #POWER ON
-        epdconfig.delay_ms(100)
-        self.ReadBusy()
-
-        self.send_command(0X00)			#PANNEL SETTING
-        self.send_data(0x1F)   #KW-3f   KWR-2F	BWROTP 0f	BWOTP 1f
-
-        self.send_command(0x61)        	#tres
-        self.send_data(0x03)		#source 800
-        self.send_data(0x20)
-        self.send_data(0x01)		#gate 480
-        self.send_data(0xE0)
-
-        self.send_command(0X15)
-        self.send_data(0x00)
-
-        # If the screen appears gray, use the annotated initialization command
-        self.send_command(0X50)
-        self.send_data(0x10)
-        self.send_data(0x07)
-        # self.send_command(0X50)
-        # self.send_data(0x10)
-        # self.send_data(0x17)
-        # self.send_command(0X52)		
-        # self.send_data(0x03)
-
-        self.send_command(0X60)			#TCON SETTING
-        self.send_data(0x22)
-
+        self.send_sequence(sequence)
         # EPD hardware init end
         return 0
+
+    def init(self):
+        return self.init_sequence(INIT)
     
     def init_fast(self):
-        if (epdconfig.module_init() != 0):
-            return -1
-        # EPD hardware init start
-        self.reset()
-        
-        self.send_command(0X00)			#PANNEL SETTING
-        self.send_data(0x1F)   #KW-3f   KWR-2F	BWROTP 0f	BWOTP 1f
-
-        # If the screen appears gray, use the annotated initialization command
-        self.send_command(0X50)
-        self.send_data(0x10)
-        self.send_data(0x07)
-        # self.send_command(0X50)
-        # self.send_data(0x10)
-        # self.send_data(0x17)
-        # self.send_command(0X52)		
-        # self.send_data(0x03)
-
-        self.send_command(0x04) #POWER ON
-        epdconfig.delay_ms(100) 
-        self.ReadBusy()        #waiting for the electronic paper IC to release the idle signal
-
-        #Enhanced display drive(Add 0x06 command)
-        self.send_command(0x06)			#Booster Soft Start 
-        self.send_data (0x27)
-        self.send_data (0x27)   
-        self.send_data (0x18)		
-        self.send_data (0x17)		
-
-        self.send_command(0xE0)
-        self.send_data(0x02)
-        self.send_command(0xE5)
-        self.send_data(0x5A)
-
-        # EPD hardware init end
-        return 0
+        return self.init_sequence(INIT_FAST)
     
     def init_part(self):
-        if (epdconfig.module_init() != 0):
-            return -1
-        # EPD hardware init start
-        self.reset()
-
-        self.send_command(0X00)			#PANNEL SETTING
-        self.send_data(0x1F)   #KW-3f   KWR-2F	BWROTP 0f	BWOTP 1f
-
-        self.send_command(0x04) #POWER ON
-        epdconfig.delay_ms(100) 
-        self.ReadBusy()        #waiting for the electronic paper IC to release the idle signal
-
-        self.send_command(0xE0)
-        self.send_data(0x02)
-        self.send_command(0xE5)
-        self.send_data(0x6E)
-
-        # EPD hardware init end
-        return 0
+        return self.init_sequence(INIT_PART)
     
     # The feature will only be available on screens sold after 24/10/23
     def init_4Gray(self):
-        if (epdconfig.module_init() != 0):
-            return -1
-        # EPD hardware init start
-        self.reset()
-
-        self.send_command(0X00)			#PANNEL SETTING
-        self.send_data(0x1F)   #KW-3f   KWR-2F	BWROTP 0f	BWOTP 1f
-        
-        self.send_command(0X50)
-        self.send_data(0x10)
-        self.send_data(0x07)
-
-        self.send_command(0x04) #POWER ON
-        epdconfig.delay_ms(100) 
-        self.ReadBusy()        #waiting for the electronic paper IC to release the idle signal
-
-        #Enhanced display drive(Add 0x06 command)
-        self.send_command(0x06)			#Booster Soft Start 
-        self.send_data (0x27)
-        self.send_data (0x27)   
-        self.send_data (0x18)		
-        self.send_data (0x17)	
-
-        self.send_command(0xE0)
-        self.send_data(0x02)
-        self.send_command(0xE5)
-        self.send_data(0x5F)
-
-        # EPD hardware init end
-        return 0
+        return self.init_sequence(INIT_4GRAY)
 
     def getbuffer(self, image):
         img = image
         imwidth, imheight = img.size
         if(imwidth == self.width and imheight == self.height):
-            img = img.convert('1')
+            pass
         elif(imwidth == self.height and imheight == self.width):
             # image has correct dimensions, but needs to be rotated
-            img = img.rotate(90, expand=True).convert('1')
+            img = img.transpose(Image.Transpose.ROTATE_90)
         else:
             logger.warning("Wrong image dimensions: must be " + str(self.width) + "x" + str(self.height))
             # return a blank buffer
-            return [0x00] * (int(self.width/8) * self.height)
+            return self.black_buffer
+        if img.mode != '1':
+            img = img.convert('1')
 
-        buf = bytearray(img.tobytes('raw'))
         # The bytes need to be inverted, because in the PIL world 0=black and 1=white, but
-        # in the e-paper world 0=white and 1=black.
-        for i in range(len(buf)):
-            buf[i] ^= 0xFF
-        return buf
+        # in the e-paper world 0=white and 1=black. The '1;I' packer does it in one pass.
+        return img.tobytes('raw', '1;I')
     
     def getbuffer_4Gray(self, image):
-        # logger.debug("bufsiz = ",int(self.width/8) * self.height)
-        buf = [0xFF] * (int(self.width / 4) * self.height)
-        image_monocolor = image.convert('L')
-        imwidth, imheight = image_monocolor.size
-        pixels = image_monocolor.load()
-        i=0
-        # logger.debug("imwidth = %d, imheight = %d",imwidth,imheight)
+        img = image.convert('L')
+        imwidth, imheight = img.size
         if(imwidth == self.width and imheight == self.height):
             logger.debug("Vertical")
-            for y in range(imheight):
-                for x in range(imwidth):
-                    # Set the bits for the column of pixels at the current position.
-                    if(pixels[x, y] == 0xC0):
-                        pixels[x, y] = 0x80
-                    elif (pixels[x, y] == 0x80):
-                        pixels[x, y] = 0x40
-                    i= i+1
-                    if(i%4 == 0):
-                        buf[int((x + (y * self.width))/4)] = ((pixels[x-3, y]&0xc0) | (pixels[x-2, y]&0xc0)>>2 | (pixels[x-1, y]&0xc0)>>4 | (pixels[x, y]&0xc0)>>6)
-                        
         elif(imwidth == self.height and imheight == self.width):
             logger.debug("Horizontal")
-            for x in range(imwidth):
-                for y in range(imheight):
-                    newx = y
-                    newy = self.height - x - 1
-                    if(pixels[x, y] == 0xC0):
-                        pixels[x, y] = 0x80
-                    elif (pixels[x, y] == 0x80):
-                        pixels[x, y] = 0x40
-                    i= i+1
-                    if(i%4 == 0):
-                        buf[int((newx + (newy * self.width))/4)] = ((pixels[x, y-3]&0xc0) | (pixels[x, y-2]&0xc0)>>2 | (pixels[x, y-1]&0xc0)>>4 | (pixels[x, y]&0xc0)>>6) 
-        return buf
+            img = img.transpose(Image.Transpose.ROTATE_90)
+        else:
+            return b'\xff' * (int(self.width / 4) * self.height)
+        # Both bits of every pixel code as 1-bit planes, then interleaved into
+        # 2 bits per pixel, 4 pixels per byte with the first one in the top bits
+        high = img.point(GRAY4_HIGH_BIT, '1').tobytes()
+        low = img.point(GRAY4_LOW_BIT, '1').tobytes()
+        size = len(high) * 2
+        return (int.from_bytes(spread_bits(high), 'big') << 1 | int.from_bytes(spread_bits(low), 'big')).to_bytes(size, 'big')
 
     def display(self, image):
-        if(self.width % 8 == 0):
-            Width = self.width // 8
-        else:
-            Width = self.width // 8 +1
-        Height = self.height
-        image1 = [0xFF] * int(self.width * self.height / 8)
-        for j in range(Height):
-                for i in range(Width):
-                    image1[i + j * Width] = ~image[i + j * Width]
+        # The 0x10 (old data) plane is the bitwise complement of the 0x13 plane
         self.send_command(0x10)
-        self.send_data2(image1)
+        self.send_data2(bytes(image).translate(INVERT_TABLE))
 
         self.send_command(0x13)
         self.send_data2(image)
@@ -312,137 +290,75 @@ class EPD:
 
     def Clear(self):
         self.send_command(0x10)
-        self.send_data2([0xFF] * int(self.width * self.height / 8))
+        self.send_data2(self.white_buffer)
         self.send_command(0x13)
-        self.send_data2([0x00] * int(self.width * self.height / 8))
+        self.send_data2(self.black_buffer)
 
         self.send_command(0x12)
         epdconfig.delay_ms(100)
         self.ReadBusy()
 
-    def display_Partial(self, Image, Xstart, Ystart, Xend, Yend):
-        if((Xstart % 8 + Xend % 8 == 8 & Xstart % 8 > Xend % 8) | Xstart % 8 + Xend % 8 == 0 | (Xend - Xstart)%8 == 0):
-            Xstart = Xstart // 8 * 8
-            Xend = Xend // 8 * 8
-        else:
-            Xstart = Xstart // 8 * 8
-            if Xend % 8 == 0:
-                Xend = Xend // 8 * 8
-            else:
-                Xend = Xend // 8 * 8 + 1
-                
+    # Image is the full-screen buffer from getbuffer(), only the window is sent. OldImage is the
+    # frame the panel shows now, its window goes to the old data RAM (0x10), which does not
+    # survive sleep() and picks each pixel's waveform together with the new data
+    def display_Partial(self, Image, Xstart, Ystart, Xend, Yend, OldImage=None):
+        # The panel RAM window must be byte aligned horizontally
+        Xstart = Xstart // 8 * 8
+        Xend = (Xend + 7) // 8 * 8
+        Xend = min(Xend, self.width)
+        Yend = min(Yend, self.height)
+        if Xstart >= Xend or Ystart >= Yend:
+            return
+        stride = self.width // 8
         Width = (Xend - Xstart) // 8
-        Height = Yend - Ystart
-	
-        self.send_command(0x50)
-        self.send_data(0xA9)
-        self.send_data(0x07)
 
-        self.send_command(0x91)		#This command makes the display enter partial mode
-        self.send_command(0x90)		#resolution setting
-        self.send_data (Xstart//256)
-        self.send_data (Xstart%256)   #x-start    
+        self.send_command_data(0x50, b'\xa9\x07')
 
-        self.send_data ((Xend-1)//256)		
-        self.send_data ((Xend-1)%256)  #x-end	
+        self.send_command(0x91)		#This command makes the display enter partial mode
+        self.send_command_data(0x90, bytes((		#resolution setting
+            Xstart//256, Xstart%256,              #x-start
+            (Xend-1)//256, (Xend-1)%256,          #x-end
+            Ystart//256, Ystart%256,              #y-start
+            (Yend-1)//256, (Yend-1)%256,          #y-end
+            0x01)))
 
-        self.send_data (Ystart//256)  #
-        self.send_data (Ystart%256)   #y-start    
+        offset = Xstart // 8
 
-        self.send_data ((Yend-1)//256)		
-        self.send_data ((Yend-1)%256)  #y-end
-        self.send_data (0x01)
+        def window(image):
+            view = memoryview(image)
+            return b''.join(view[y * stride + offset:y * stride + offset + Width] for y in range(Ystart, Yend))
 
-        image1 = [0xFF] * int(self.width * self.height / 8)
-        for j in range(Height):
-                for i in range(Width):
-                    image1[i + j * Width] = ~Image[i + j * Width]
+        if OldImage is not None:
+            self.send_command(0x10)   #Write the previous image to the old data RAM
+            self.send_data2(window(OldImage).translate(INVERT_TABLE))
 
         self.send_command(0x13)   #Write Black and White image to RAM
-        self.send_data2(image1)
+        self.send_data2(window(Image).translate(INVERT_TABLE))
 
         self.send_command(0x12)
         epdconfig.delay_ms(100)
         self.ReadBusy()
 
     def display_4Gray(self, image):
+        # Image is the 2 bits per pixel buffer from getbuffer_4Gray(), split into the two planes
+        img = Image.frombytes('L', (self.width, self.height), bytes(image), 'raw', 'L;2')
         self.send_command(0x10)
-        for i in range(0, 48000):     
-            temp3=0
-            for j in range(0, 2):
-                temp1 = image[i*2+j]
-                for k in range(0, 2):
-                    temp2 = temp1&0xC0 
-                    if(temp2 == 0xC0):
-                        temp3 |= 0x00
-                    elif(temp2 == 0x00):
-                        temp3 |= 0x01  
-                    elif(temp2 == 0x80): 
-                        temp3 |= 0x01 
-                    else: #0x40
-                        temp3 |= 0x00 
-                    temp3 <<= 1	
-                    
-                    temp1 <<= 2
-                    temp2 = temp1&0xC0 
-                    if(temp2 == 0xC0): 
-                        temp3 |= 0x00
-                    elif(temp2 == 0x00): 
-                        temp3 |= 0x01
-                    elif(temp2 == 0x80):
-                        temp3 |= 0x01
-                    else :   #0x40
-                        temp3 |= 0x00	
-                    if(j!=1 or k!=1):				
-                        temp3 <<= 1
-                    temp1 <<= 2
-            self.send_data(temp3)
-            
-        self.send_command(0x13)	       
-        for i in range(0, 48000):       
-            temp3=0
-            for j in range(0, 2):
-                temp1 = image[i*2+j]
-                for k in range(0, 2):
-                    temp2 = temp1&0xC0 
-                    if(temp2 == 0xC0):
-                        temp3 |= 0x00
-                    elif(temp2 == 0x00):
-                        temp3 |= 0x01
-                    elif(temp2 == 0x80):
-                        temp3 |= 0x00
-                    else: #0x40
-                        temp3 |= 0x01 
-                    temp3 <<= 1	
-                    
-                    temp1 <<= 2
-                    temp2 = temp1&0xC0 
-                    if(temp2 == 0xC0): 
-                        temp3 |= 0x00
-                    elif(temp2 == 0x00): 
-                        temp3 |= 0x01
-                    elif(temp2 == 0x80):
-                        temp3 |= 0x00 
-                    else:    #0x40
-                            temp3 |= 0x01	
-                    if(j!=1 or k!=1):					
-                        temp3 <<= 1
-                    temp1 <<= 2
-            self.send_data(temp3)
-        
+        self.send_data2(img.point(GRAY4_OLD_PLANE, '1').tobytes())
+
+        self.send_command(0x13)
+        self.send_data2(img.point(GRAY4_NEW_PLANE, '1').tobytes())
+
         self.send_command(0x12)
         epdconfig.delay_ms(100)
         self.ReadBusy()
 
     def sleep(self):
-        self.send_command(0x50)
-        self.send_data(0XF7)
+        self.send_command_data(0x50, b'\xf7')
         
         self.send_command(0x02) # POWER_OFF
         self.ReadBusy()
         
-        self.send_command(0x07) # DEEP_SLEEP
-        self.send_data(0XA5)
+        self.send_command_data(0x07, b'\xa5') # DEEP_SLEEP
         
         epdconfig.delay_ms(2000)
         epdconfig.module_exit()
@@ -37,6 +37,50 @@ from ctypes import *
 
 logger = logging.getLogger(__name__)
 
+# SPI clock, override with EPD_SPI_HZ=<hz> for boards and panels that run faster
+SPI_SPEED_HZ = int(os.environ.get('EPD_SPI_HZ', 4000000))
+SPI_BUFSIZ_PATH = '/sys/module/spidev/parameters/bufsiz'
+SPI_BUFSIZ = 4096  # spidev default
+
+
+def spi_bufsiz():
+    # Largest transfer the spidev driver accepts in one ioctl
+    try:
+        with open(SPI_BUFSIZ_PATH) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return SPI_BUFSIZ
+
+
+def spi_write_chunked(write, data, chunk):
+    # Streams bytes-like data through write() in chunks without copying it
+    if not isinstance(data, (bytes, bytearray, memoryview)):
+        data = bytes(data)
+    with memoryview(data) as view:
+        for i in range(0, len(view), chunk):
+            write(view[i:i + chunk])
+
+
+def load_spi_bulk(so_filename):
+    # SYSFS_software_spi_writebytes(data, len) from sysfs_software_spi_bulk.c
+    writebytes = CDLL(so_filename).SYSFS_software_spi_writebytes
+    writebytes.argtypes = [c_char_p, c_size_t]
+    writebytes.restype = None
+    return writebytes
+
+
+def wait_for_level(GPIO, pin, value, timeout):
+    # Edge waits for RPi.GPIO style modules, False on timeout. The level is checked
+    # between short waits so an edge just before wait_for_edge() is not missed.
+    deadline = time.monotonic() + timeout
+    edge = GPIO.RISING if value else GPIO.FALLING
+    while GPIO.input(pin) != value:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        GPIO.wait_for_edge(pin, edge, timeout=max(1, int(min(remaining, 0.1) * 1000)))
+    return True
+
 
 class RaspberryPi:
     # Pin definition
@@ -53,47 +97,44 @@ class RaspberryPi:
         import gpiozero
         
         self.SPI = spidev.SpiDev()
+        self.spi_speed_hz = SPI_SPEED_HZ
+        self.spi_chunk = spi_bufsiz()
         self.GPIO_RST_PIN    = gpiozero.LED(self.RST_PIN)
         self.GPIO_DC_PIN     = gpiozero.LED(self.DC_PIN)
         # self.GPIO_CS_PIN     = gpiozero.LED(self.CS_PIN)
         self.GPIO_PWR_PIN    = gpiozero.LED(self.PWR_PIN)
         self.GPIO_BUSY_PIN   = gpiozero.Button(self.BUSY_PIN, pull_up = False)
+        # pin number -> gpiozero device, for digital_write() and digital_read()
+        self.GPIO_OUTPUT_PINS = {
+            self.RST_PIN: self.GPIO_RST_PIN,
+            self.DC_PIN: self.GPIO_DC_PIN,
+            self.PWR_PIN: self.GPIO_PWR_PIN,
+        }
+        self.GPIO_PINS = dict(self.GPIO_OUTPUT_PINS)
+        self.GPIO_PINS[self.BUSY_PIN] = self.GPIO_BUSY_PIN
 
         
 
     def digital_write(self, pin, value):
-        if pin == self.RST_PIN:
-            if value:
-                self.GPIO_RST_PIN.on()
-            else:
-                self.GPIO_RST_PIN.off()
-        elif pin == self.DC_PIN:
-            if value:
-                self.GPIO_DC_PIN.on()
-            else:
-                self.GPIO_DC_PIN.off()
-        # elif pin == self.CS_PIN:
-        #     if value:
-        #         self.GPIO_CS_PIN.on()
-        #     else:
-        #         self.GPIO_CS_PIN.off()
-        elif pin == self.PWR_PIN:
-            if value:
-                self.GPIO_PWR_PIN.on()
-            else:
-                self.GPIO_PWR_PIN.off()
+        # CS is driven by the SPI controller and has no entry
+        device = self.GPIO_OUTPUT_PINS.get(pin)
+        if device is None:
+            return
+        if value:
+            device.on()
+        else:
+            device.off()
 
     def digital_read(self, pin):
-        if pin == self.BUSY_PIN:
-            return self.GPIO_BUSY_PIN.value
-        elif pin == self.RST_PIN:
-            return self.RST_PIN.value
-        elif pin == self.DC_PIN:
-            return self.DC_PIN.value
-        # elif pin == self.CS_PIN:
-        #     return self.CS_PIN.value
-        elif pin == self.PWR_PIN:
-            return self.PWR_PIN.value
+        return self.GPIO_PINS[pin].value
+
+    def digital_wait(self, pin, value, timeout):
+        # Blocks on the gpiozero edge event instead of polling, False on timeout
+        if pin != self.BUSY_PIN:
+            return None
+        if value:
+            return self.GPIO_BUSY_PIN.wait_for_active(timeout)
+        return self.GPIO_BUSY_PIN.wait_for_inactive(timeout)
 
     def delay_ms(self, delaytime):
         time.sleep(delaytime / 1000.0)
@@ -102,7 +143,11 @@ class RaspberryPi:
         self.SPI.writebytes(data)
 
     def spi_writebyte2(self, data):
-        self.SPI.writebytes2(data)
+        spi_write_chunked(self.SPI.writebytes2, data, self.spi_chunk)
+
+    def spi_set_speed(self, hz):
+        self.spi_speed_hz = hz
+        self.SPI.max_speed_hz = hz
 
     def DEV_SPI_write(self, data):
         self.DEV_SPI.DEV_SPI_SendData(data)
@@ -141,7 +186,7 @@ class RaspberryPi:
         else:
             # SPI device, bus = 0, device = 0
             self.SPI.open(0, 0)
-            self.SPI.max_speed_hz = 4000000
+            self.SPI.max_speed_hz = self.spi_speed_hz
             self.SPI.mode = 0b00
         return 0
 
@@ -181,13 +226,22 @@ class JetsonNano:
             '/usr/lib',
         ]
         self.SPI = None
+        self.SPI_BULK = None
         for find_dir in find_dirs:
             so_filename = os.path.join(find_dir, 'sysfs_software_spi.so')
             if os.path.exists(so_filename):
-                self.SPI = ctypes.cdll.LoadLibrary(so_filename)
+                # global, so the optional bulk library resolves the transfer function from it
+                self.SPI = ctypes.CDLL(so_filename, mode=ctypes.RTLD_GLOBAL)
                 break
         if self.SPI is None:
             raise RuntimeError('Cannot find sysfs_software_spi.so')
+        for find_dir in find_dirs:
+            so_filename = os.path.join(find_dir, 'sysfs_software_spi_bulk.so')
+            if os.path.exists(so_filename):
+                self.SPI_BULK = load_spi_bulk(so_filename)
+                break
+        if self.SPI_BULK is None:
+            logger.debug("sysfs_software_spi_bulk.so is not found, bytes are sent one call each")
 
         import Jetson.GPIO
         self.GPIO = Jetson.GPIO
@@ -198,6 +252,9 @@ class JetsonNano:
     def digital_read(self, pin):
         return self.GPIO.input(self.BUSY_PIN)
 
+    def digital_wait(self, pin, value, timeout):
+        return wait_for_level(self.GPIO, pin, value, timeout)
+
     def delay_ms(self, delaytime):
         time.sleep(delaytime / 1000.0)
 
@@ -205,8 +262,14 @@ class JetsonNano:
         self.SPI.SYSFS_software_spi_transfer(data[0])
 
     def spi_writebyte2(self, data):
-        for i in range(len(data)):
-            self.SPI.SYSFS_software_spi_transfer(data[i])
+        if self.SPI_BULK is not None:
+            if not isinstance(data, bytes):
+                data = bytes(data)
+            self.SPI_BULK(data, len(data))
+            return
+        transfer = self.SPI.SYSFS_software_spi_transfer
+        for value in data:
+            transfer(value)
 
     def module_init(self):
         self.GPIO.setmode(self.GPIO.BCM)
@@ -249,6 +312,8 @@ class SunriseX3:
 
         self.GPIO = Hobot.GPIO
         self.SPI = spidev.SpiDev()
+        self.spi_speed_hz = SPI_SPEED_HZ
+        self.spi_chunk = spi_bufsiz()
 
     def digital_write(self, pin, value):
         self.GPIO.output(pin, value)
@@ -256,6 +321,9 @@ class SunriseX3:
     def digital_read(self, pin):
         return self.GPIO.input(pin)
 
+    def digital_wait(self, pin, value, timeout):
+        return wait_for_level(self.GPIO, pin, value, timeout)
+
     def delay_ms(self, delaytime):
         time.sleep(delaytime / 1000.0)
 
@@ -265,7 +333,11 @@ class SunriseX3:
     def spi_writebyte2(self, data):
         # for i in range(len(data)):
         #     self.SPI.writebytes([data[i]])
-        self.SPI.xfer3(data)
+        spi_write_chunked(self.SPI.writebytes2, data, self.spi_chunk)
+
+    def spi_set_speed(self, hz):
+        self.spi_speed_hz = hz
+        self.SPI.max_speed_hz = hz
 
     def module_init(self):
         if self.Flag == 0:
@@ -282,7 +354,7 @@ class SunriseX3:
         
             # SPI device, bus = 0, device = 0
             self.SPI.open(2, 0)
-            self.SPI.max_speed_hz = 4000000
+            self.SPI.max_speed_hz = self.spi_speed_hz
             self.SPI.mode = 0b00
             return 0
         else:
@@ -301,22 +373,28 @@ class SunriseX3:
         self.GPIO.cleanup([self.RST_PIN, self.DC_PIN, self.CS_PIN, self.BUSY_PIN], self.PWR_PIN)
 
 
-if sys.version_info[0] == 2:
-    process = subprocess.Popen("cat /proc/cpuinfo | grep Raspberry", shell=True, stdout=subprocess.PIPE)
-else:
-    process = subprocess.Popen("cat /proc/cpuinfo | grep Raspberry", shell=True, stdout=subprocess.PIPE, text=True)
-output, _ = process.communicate()
-if sys.version_info[0] == 2:
-    output = output.decode(sys.stdout.encoding)
+def detect_implementation():
+    if sys.version_info[0] == 2:
+        process = subprocess.Popen("cat /proc/cpuinfo | grep Raspberry", shell=True, stdout=subprocess.PIPE)
+    else:
+        process = subprocess.Popen("cat /proc/cpuinfo | grep Raspberry", shell=True, stdout=subprocess.PIPE, text=True)
+    output, _ = process.communicate()
+    if sys.version_info[0] == 2:
+        output = output.decode(sys.stdout.encoding)
+
+    if "Raspberry" in output:
+        return RaspberryPi()
+    elif os.path.exists('/sys/bus/platform/drivers/gpio-x3'):
+        return SunriseX3()
+    else:
+        return JetsonNano()
+
 
-if "Raspberry" in output:
-    implementation = RaspberryPi()
-elif os.path.exists('/sys/bus/platform/drivers/gpio-x3'):
-    implementation = SunriseX3()
-else:
-    implementation = JetsonNano()
+# EPD_BOARD_DETECT=0 loads only the helpers and board classes, for checks off the board
+if os.environ.get('EPD_BOARD_DETECT', '1') != '0':
+    implementation = detect_implementation()
 
-for func in [x for x in dir(implementation) if not x.startswith('_')]:
-    setattr(sys.modules[__name__], func, getattr(implementation, func))
+    for func in [x for x in dir(implementation) if not x.startswith('_')]:
+        setattr(sys.modules[__name__], func, getattr(implementation, func))
 
 ### END OF FILE ###
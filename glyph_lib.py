@@ -0,0 +1,124 @@
+import os
+import struct
+from collections import Counter
+import PIL
+from PIL import Image, ImageDraw, ImageChops
+
+# Characters used by the clock, temperature and sensor lines
+CHARS = '0123456789:.-°% '
+# Cache file: magic, glyph count, then per glyph a header and the PIL '1' raw mask bytes
+GLYPHS_MAGIC = b'GLY2'
+GLYPHS_HEADER = struct.Struct('<4sH')
+GLYPH_HEADER = struct.Struct('<IHHhhd?')  # char, width, height, left, top, advance, exact
+
+
+class GlyphAtlas:
+    def __init__(self, font, chars=CHARS, cache_dir=None):
+        self.font = font
+        self.glyphs = None
+        self.exact = None  # chars that draw_text() places exactly like FreeType does
+        cache_file = None
+        if cache_dir:
+            # hinting depends on the FreeType build, so the Pillow version is part of the name
+            name = f'{os.path.basename(font.path)}_{font.size}_{int(os.path.getmtime(font.path))}_{PIL.__version__}.glyphs'
+            cache_file = os.path.join(cache_dir, name)
+            self.load(cache_file, chars)
+        if self.glyphs is None:
+            self.glyphs = {ch: self.render_glyph(ch) for ch in chars}
+            self.exact = self.verify(chars)
+            if cache_file:
+                self.save(cache_file)
+
+    def render_glyph(self, ch):
+        # 1-bit mask (1 = ink) of the glyph bounding box, its offset from the pen and the advance
+        left, top, right, bottom = self.font.getbbox(ch)
+        mask = Image.new('1', (max(right - left, 1), max(bottom - top, 1)), 0)
+        if right > left and bottom > top:
+            ImageDraw.Draw(mask).text((-left, -top), ch, font=self.font, fill=1)
+        return mask, left, top, self.font.getlength(ch)
+
+    def matches(self, text, margin=8):
+        # draw_text() against FreeType rendering the whole string
+        left, top, right, bottom = self.font.getbbox(text)
+        size = (max(right, 1) + margin * 2, max(bottom, 1) + margin * 2)
+        atlas = Image.new('1', size, 1)
+        self.draw_text(atlas, text, margin, margin)
+        freetype = Image.new('1', size, 1)
+        ImageDraw.Draw(freetype).text((margin, margin), text, font=self.font, fill=0)
+        return ImageChops.difference(atlas, freetype).getbbox() is None
+
+    def verify(self, chars):
+        # Hinting can move a glyph by a pixel inside a string, so every pair of chars is
+        # compared and the char in most mismatches is dropped until all pairs match
+        exact = set(chars)
+        while exact:
+            failed = Counter()
+            for a in exact:
+                for b in exact:
+                    if not self.matches(a + b):
+                        failed.update({a, b})
+            if not failed:
+                break
+            exact.discard(failed.most_common(1)[0][0])
+        return exact
+
+    def load(self, cache_file, chars):
+        try:
+            with open(cache_file, 'rb') as f:
+                data = f.read()
+            magic, count = GLYPHS_HEADER.unpack_from(data)
+            if magic != GLYPHS_MAGIC:
+                return
+            glyphs = {}
+            exact = set()
+            pos = GLYPHS_HEADER.size
+            for _ in range(count):
+                code, width, height, left, top, advance, is_exact = GLYPH_HEADER.unpack_from(data, pos)
+                pos += GLYPH_HEADER.size
+                size = (width + 7) // 8 * height
+                if pos + size > len(data):
+                    return
+                glyphs[chr(code)] = (Image.frombytes('1', (width, height), data[pos:pos + size]), left, top, advance)
+                if is_exact:
+                    exact.add(chr(code))
+                pos += size
+        except (OSError, struct.error, ValueError):
+            return
+        if set(chars) != set(glyphs):
+            return
+        self.glyphs = glyphs
+        self.exact = exact
+
+    def save(self, cache_file):
+        data = [GLYPHS_HEADER.pack(GLYPHS_MAGIC, len(self.glyphs))]
+        for ch, (mask, left, top, advance) in self.glyphs.items():
+            data.append(GLYPH_HEADER.pack(ord(ch), *mask.size, left, top, advance, ch in self.exact))
+            data.append(mask.tobytes())
+        tmp_path = cache_file + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(b''.join(data))
+            os.replace(tmp_path, cache_file)
+        except OSError as e:
+            print(f'Glyph cache is not saved: {e}')
+
+    def supports(self, text):
+        return all(ch in self.exact for ch in text)
+
+    def layout(self, text):
+        pen = 0
+        for ch in text:
+            mask, left, top, advance = self.glyphs[ch]
+            yield mask, int(pen) + left, top
+            pen += advance
+
+    def getbbox(self, text):
+        boxes = [(x, y, x + mask.width, y + mask.height) for mask, x, y in self.layout(text) if mask.getbbox()]
+        if not boxes:
+            return 0, 0, 0, 0
+        return min(b[0] for b in boxes), min(b[1] for b in boxes), max(b[2] for b in boxes), max(b[3] for b in boxes)
+
+    def draw_text(self, image, text, x, y, fill=0):
+        for mask, dx, dy in self.layout(text):
+            image.paste(fill, (x + dx, y + dy), mask)
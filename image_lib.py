@@ -0,0 +1,105 @@
+import os
+import sys
+import mmap
+import random
+import struct
+from functools import lru_cache
+from PIL import Image
+
+ASSET_SIZE = (800, 250)
+# Packed asset: magic, width, height, then rows of PIL '1' raw bytes (1 = white)
+PACKED_EXT = '.epb'
+PACKED_MAGIC = b'EPB1'
+PACKED_HEADER = struct.Struct('<4sHH')
+
+
+def parse_range(s):
+    start, *end = s.split('-')
+    end = end[0] if end else start
+    return int(start), int(end) + 1
+
+
+def save_packed(img, path):
+    # the app may load the asset while it is converted, so it is replaced in one step
+    img = img.convert('1')
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(PACKED_HEADER.pack(PACKED_MAGIC, *img.size))
+        f.write(img.tobytes())
+    os.replace(tmp_path, path)
+
+
+def load_packed(path, size=None):
+    # size: the expected (width, height), ValueError for anything else or a truncated file
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        magic, width, height = PACKED_HEADER.unpack_from(mm)
+        if magic != PACKED_MAGIC:
+            raise ValueError(f'{path} is not a packed image')
+        if size and (width, height) != size:
+            raise ValueError(f'{path} is {width}x{height}, must be {size[0]}x{size[1]}')
+        if len(mm) - PACKED_HEADER.size != (width + 7) // 8 * height:
+            raise ValueError(f'{path} has {len(mm) - PACKED_HEADER.size} bytes of data for {width}x{height}')
+        with memoryview(mm) as view, view[PACKED_HEADER.size:] as data:
+            return Image.frombytes('1', (width, height), data)
+
+
+def convert(path='./img/'):
+    # Store every png as a packed 1-bit asset next to it, returns errors for rejected files
+    errors = []
+    for root, _, files in os.walk(path):
+        for file in sorted(files):
+            if not file.endswith('.png'):
+                continue
+            png_path = os.path.join(root, file)
+            with Image.open(png_path) as img:
+                if img.size != ASSET_SIZE:
+                    errors.append(f'{png_path}: {img.size[0]}x{img.size[1]}, must be {ASSET_SIZE[0]}x{ASSET_SIZE[1]}')
+                    continue
+                save_packed(img, os.path.splitext(png_path)[0] + PACKED_EXT)
+    return errors
+
+
+class ImageLibrary:
+    # Calendar index of <month>_<day>_<comment>.png files, month or day 0 matches any date
+    def __init__(self, path='./img/', cache_size=4):
+        self.index = []
+        for root, _, files in os.walk(path):
+            for file in sorted(files):
+                if not file.endswith('.png'):
+                    continue
+                m, d, *_ = file.split('_')
+                self.index.append((parse_range(m), parse_range(d), os.path.join(root, file)))
+        self.load = lru_cache(maxsize=cache_size)(self.load_image)
+        self.paths = lru_cache(maxsize=2)(self.day_paths)
+
+    def month_entries(self, month):
+        return [(d, path) for m, d, path in self.index if m[0] <= month < m[1]]
+
+    def day_paths(self, month, day):
+        entries = self.month_entries(month) or self.month_entries(0)
+        return ([path for d, path in entries if d[0] <= day < d[1]] or
+                [path for d, path in entries if d[0] <= 0 < d[1]])
+
+    def load_image(self, path):
+        packed_path = os.path.splitext(path)[0] + PACKED_EXT
+        if os.path.exists(packed_path) and os.path.getmtime(packed_path) >= os.path.getmtime(path):
+            try:
+                return load_packed(packed_path, ASSET_SIZE)
+            except (OSError, ValueError, struct.error) as e:
+                print(f'Packed image is not used: {e}')
+        with Image.open(path) as img:
+            return img.convert('1')
+
+    def choice(self, t):
+        paths = self.paths(t.tm_mon, t.tm_mday)
+        if not paths:
+            return None
+        # one image for the whole day, so the background is unchanged between minutes
+        return self.load(random.Random(t.tm_year * 1000 + t.tm_yday).choice(paths))
+
+
+if __name__ == "__main__":
+    errors = convert(*sys.argv[1:])
+    for error in errors:
+        print(error)
+    sys.exit(1 if errors else 0)
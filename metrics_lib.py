@@ -0,0 +1,103 @@
+import os
+import time
+import threading
+import functools
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds, from a glyph paste to a full refresh
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    # Latency histograms per stage, exported in Prometheus text format
+    def __init__(self, name='epaper_stage_seconds', buckets=BUCKETS):
+        self.name = name
+        self.buckets = buckets
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = Histogram(self.buckets)
+            self.histograms[stage].observe(seconds)
+
+    def timed(self, stage, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.observe(stage, time.perf_counter() - start)
+        return wrapper
+
+    def stage(self, name):
+        # Method decorator
+        return lambda func: self.timed(name, func)
+
+    def instrument(self, obj, *names):
+        # Time the bound methods of obj that exist, e.g. the driver of a real panel only
+        for name in names:
+            if hasattr(obj, name):
+                setattr(obj, name, self.timed(name, getattr(obj, name)))
+
+    def render(self):
+        lines = [f'# HELP {self.name} Time spent in each stage of a display refresh.',
+                 f'# TYPE {self.name} histogram']
+        with self.lock:
+            for stage, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for le, count in zip(self.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'{self.name}_sum{{stage="{stage}"}} {histogram.sum:.6f}')
+                lines.append(f'{self.name}_count{{stage="{stage}"}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        # Replaced atomically, for the node_exporter textfile collector
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def serve(self, port, host=''):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+METRICS = Metrics()
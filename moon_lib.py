@@ -1,48 +1,90 @@
 import math
-from datetime import datetime
+from datetime import datetime, timedelta
+
+EPOCH = datetime(2000, 1, 1)
 
 
 def phase_of_moon(latitude, longitude, date):
-    # Convert date to Julian date
-    jd = (date - datetime(2000, 1, 1)).total_seconds() / 86400 + 2451545.0
-
-    # Calculate the moon's mean longitude
-    L = (218.316 + 13.176396 * jd) % 360
-
-    # Calculate the moon's mean anomaly
-    M = (134.963 + 13.064993 * jd) % 360
-
-    # Calculate the moon's argument of latitude
-    F = (93.272 + 13.229350 * jd) % 360
-
-    # Calculate the moon's ecliptic latitude and longitude
-    l = L + 6.289 * math.sin(math.radians(M))
-    b = 5.128 * math.sin(math.radians(F))
-    r = 385001 - 20905 * math.cos(math.radians(M))
-
-    # Calculate the moon's equatorial coordinates
-    obl = 23.439 - 0.0000004 * jd
-    x = r * math.cos(math.radians(l))
-    y = r * math.cos(math.radians(obl)) * math.sin(math.radians(l))
-    z = r * math.sin(math.radians(obl)) * math.sin(math.radians(l))
-
-    # Calculate the moon's right ascension and declination
-    ra = math.atan2(y, x)
-    dec = math.asin(z / r)
-
-    # Calculate the moon's phase angle
-    lst = (100.46 + 0.985647352 * jd + longitude) % 360
-    ha = (lst - ra) % 360
-    phase_angle = math.degrees(math.acos(math.sin(math.radians(latitude)) * math.sin(math.radians(dec)) + math.cos(math.radians(latitude)) * math.cos(math.radians(dec)) * math.cos(math.radians(ha))))
-
-    # Determine the phase of the moon
-    # if phase_angle < 90:
-    #     return "Waxing Crescent"
-    # elif phase_angle < 180:
-    #     return "First Quarter"
-    # elif phase_angle < 270:
-    #     return "Waxing Gibbous"
-    # else:
-    #     return "Full Moon"
-
-    return phase_angle
+    return phases_of_moon(latitude, longitude, [date])[0]
+
+
+def phases_of_moon(latitude, longitude, dates):
+    # Same as phase_of_moon for many dates, the location terms are computed once
+    sin_latitude = math.sin(math.radians(latitude))
+    cos_latitude = math.cos(math.radians(latitude))
+    phase_angles = []
+    for date in dates:
+        # Convert date to Julian date
+        jd = (date - EPOCH).total_seconds() / 86400 + 2451545.0
+
+        # Calculate the moon's mean longitude
+        L = (218.316 + 13.176396 * jd) % 360
+
+        # Calculate the moon's mean anomaly
+        M = (134.963 + 13.064993 * jd) % 360
+
+        # Calculate the moon's argument of latitude
+        F = (93.272 + 13.229350 * jd) % 360
+
+        # Calculate the moon's ecliptic latitude and longitude
+        l = L + 6.289 * math.sin(math.radians(M))
+        b = 5.128 * math.sin(math.radians(F))
+        r = 385001 - 20905 * math.cos(math.radians(M))
+
+        # Calculate the moon's equatorial coordinates
+        obl = 23.439 - 0.0000004 * jd
+        x = r * math.cos(math.radians(l))
+        y = r * math.cos(math.radians(obl)) * math.sin(math.radians(l))
+        z = r * math.sin(math.radians(obl)) * math.sin(math.radians(l))
+
+        # Calculate the moon's right ascension and declination
+        ra = math.atan2(y, x)
+        dec = math.asin(z / r)
+
+        # Calculate the moon's phase angle
+        lst = (100.46 + 0.985647352 * jd + longitude) % 360
+        ha = (lst - ra) % 360
+        phase_angle = math.degrees(math.acos(sin_latitude * math.sin(math.radians(dec)) + cos_latitude * math.cos(math.radians(dec)) * math.cos(math.radians(ha))))
+
+        # Determine the phase of the moon
+        # if phase_angle < 90:
+        #     return "Waxing Crescent"
+        # elif phase_angle < 180:
+        #     return "First Quarter"
+        # elif phase_angle < 270:
+        #     return "Waxing Gibbous"
+        # else:
+        #     return "Full Moon"
+
+        phase_angles.append(phase_angle)
+    return phase_angles
+
+
+class MoonPhaseTable:
+    # Phase angles for one location at a fixed time resolution, filled one block of steps at a time
+    def __init__(self, latitude, longitude, resolution=timedelta(hours=1), block=24, size=24 * 31):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.resolution = resolution
+        self.block = block
+        self.size = size
+        self.table = {}
+
+    def step(self, date):
+        return (date - EPOCH) // self.resolution
+
+    def fill(self, start, count):
+        steps = range(start, start + count)
+        if len(self.table) + count > self.size:
+            self.table.clear()
+        dates = [EPOCH + self.resolution * step for step in steps]
+        self.table.update(zip(steps, phases_of_moon(self.latitude, self.longitude, dates)))
+
+    def phase(self, date):
+        step = self.step(date)
+        if step not in self.table:
+            self.fill(step - step % self.block, self.block)
+        return self.table[step]
+
+    def phases(self, dates):
+        return [self.phase(date) for date in dates]
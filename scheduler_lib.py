@@ -0,0 +1,76 @@
+import math
+import time
+import threading
+
+
+class Job:
+    def __init__(self, name, period, func, offset=0):
+        self.name = name
+        self.period = period
+        self.func = func
+        self.offset = offset
+        self.slot = None
+        self.deadline = None
+        self.runs = 0
+        self.skipped = 0
+        self.lateness = 0.0
+        self.max_lateness = 0.0
+
+
+class Scheduler:
+    # Runs each job at wall clock times offset + n * period. Deadlines are kept on the
+    # monotonic clock and every next slot is derived from the slot number, so the time
+    # spent in a job never shifts the following runs. A job delayed past its next
+    # slots runs once, late, for the latest due slot and the skipped ones are counted.
+    LATE_WARNING = 1.0  # seconds
+
+    def __init__(self, monotonic=time.monotonic, wall=time.time, sleep=time.sleep):
+        self.monotonic = monotonic
+        self.wall = wall
+        self.sleep = sleep
+        self.jobs = []
+
+    def add(self, name, period, func, offset=0):
+        job = Job(name, period, func, offset)
+        self.schedule(job, math.floor((self.wall() - offset) / period) + 1)
+        self.jobs.append(job)
+        return job
+
+    def remove(self, job):
+        self.jobs.remove(job)
+
+    def schedule(self, job, slot):
+        job.slot = slot
+        job.deadline = self.monotonic() + slot * job.period + job.offset - self.wall()
+
+    def run_job(self, job):
+        now = self.monotonic()
+        job.lateness = now - job.deadline
+        job.max_lateness = max(job.max_lateness, job.lateness)
+        if job.lateness > self.LATE_WARNING:
+            print(f'Job {job.name} is {job.lateness:.1f} s late')
+        try:
+            job.func()
+        except Exception as e:
+            print(f'Job {job.name} failed: {e}')
+        job.runs += 1
+        # the next slot, or the latest one already due when the job overran its period
+        slot = max(job.slot + 1, math.floor((self.wall() - job.offset) / job.period))
+        job.skipped += slot - job.slot - 1
+        self.schedule(job, slot)
+
+    def run_pending(self):
+        for job in sorted(self.jobs, key=lambda job: job.deadline):
+            if job.deadline <= self.monotonic():
+                self.run_job(job)
+
+    def start(self):
+        # run() on a daemon thread, for jobs that must not wait behind the main thread
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            self.run_pending()
+            delay = min(job.deadline for job in self.jobs) - self.monotonic()
+            if delay > 0:
+                self.sleep(delay)
@@ -1,3 +1,9 @@
+import time
+import threading
+import http.client
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 try:
     import bme680
 except:
@@ -35,3 +41,118 @@ class Sensor:
 
     def get_humidity(self):
         return self.sensor.data.humidity
+
+
+class SensorSampler:
+    # sample() reads the sensor into a ring buffer of (time, temperature, humidity, pressure),
+    # call it off the render thread, the getters never touch the sensor
+    def __init__(self, sensor, period=10, history=3 * 3600, smoothing=6):
+        self.sensor = sensor
+        self.period = period
+        self.smoothing = smoothing
+        self.samples = deque(maxlen=int(history // period) + 1)
+        self.lock = threading.Lock()
+
+    def sample(self):
+        self.sensor.update()
+        sample = (time.monotonic(), self.sensor.get_temperature(), self.sensor.get_humidity(), self.sensor.get_pressure())
+        with self.lock:
+            self.samples.append(sample)
+
+    def update(self):
+        # values are sampled by sample()
+        pass
+
+    def mean(self, field):
+        with self.lock:
+            recent = list(self.samples)[-self.smoothing:]
+        return sum(sample[field] for sample in recent) / len(recent)
+
+    def get_temperature(self):
+        return self.mean(1)
+
+    def get_humidity(self):
+        return self.mean(2)
+
+    def get_pressure(self):
+        return self.mean(3)
+
+    def trend(self, field, seconds):
+        # change of the smoothed value against the oldest sample within seconds
+        with self.lock:
+            samples = list(self.samples)
+        since = samples[-1][0] - seconds
+        past = [sample[field] for sample in samples if sample[0] >= since][:self.smoothing]
+        return self.mean(field) - sum(past) / len(past)
+
+    def get_pressure_trend(self, seconds=3 * 3600):
+        return self.trend(3, seconds)
+
+
+class HttpSensorPoller:
+    # Polls plain-number HTTP sensors concurrently over kept-alive connections,
+    # get() returns the last value with its age in seconds
+    def __init__(self, urls, period=30, timeout=2):
+        self.urls = list(urls)
+        self.period = period
+        self.timeout = timeout
+        self.values = {}
+        self.connections = {}
+        self.reconnects = 0
+        self.executor = ThreadPoolExecutor(max_workers=max(len(self.urls), 1))
+        self.pending = {}
+
+    def poll_async(self):
+        # start a poll of every url that is not still waiting for its previous one
+        for url in self.urls:
+            if url not in self.pending or self.pending[url].done():
+                self.pending[url] = self.executor.submit(self.poll, url)
+
+    def connection(self, url):
+        # one connection per url, so it is never shared by two concurrent polls
+        conn = self.connections.get(url)
+        if conn is None:
+            parts = urlsplit(url)
+            connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+            conn = self.connections[url] = connection_class(parts.hostname, parts.port, timeout=self.timeout)
+        return conn
+
+    def request(self, url):
+        parts = urlsplit(url)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        conn = self.connection(url)
+        conn.request('GET', path)
+        response = conn.getresponse()
+        body = response.read()
+        if response.status != 200:
+            raise http.client.HTTPException(f'HTTP {response.status}')
+        return float(body)
+
+    def drop(self, url):
+        conn = self.connections.pop(url, None)
+        if conn is not None:
+            conn.close()
+
+    def poll(self, url):
+        reused = url in self.connections
+        try:
+            try:
+                value = self.request(url)
+            except (ConnectionError, http.client.ImproperConnectionState):
+                if not reused:
+                    raise
+                # the server has closed the idle kept-alive connection, try once on a new one
+                self.drop(url)
+                self.reconnects += 1
+                value = self.request(url)
+            self.values[url] = (value, time.monotonic())
+        except Exception as e:
+            # drop the connection, the next poll opens a new one
+            self.drop(url)
+            print(f"Error accessing {url}: {e}")
+
+    def get(self, url):
+        if url not in self.values:
+            return None
+        value, timestamp = self.values[url]
+        return value, time.monotonic() - timestamp
@@ -0,0 +1,54 @@
+import math
+import calendar
+from array import array
+from datetime import date, datetime
+
+POLAR = -32768  # no sunrise or sunset on that day
+
+
+def sunrise_sunset_utc(latitude, longitude, day):
+    # Sunrise equation, returns (sunrise, sunset) in minutes after UTC midnight of day
+    jd = day.toordinal() + 1721425.0  # Julian date at noon UTC
+    n = jd - 2451545.0 + 0.0008
+    mean_solar_time = n - longitude / 360
+    M = (357.5291 + 0.98560028 * mean_solar_time) % 360
+    C = 1.9148 * math.sin(math.radians(M)) + 0.02 * math.sin(math.radians(2 * M)) + 0.0003 * math.sin(math.radians(3 * M))
+    ecliptic_longitude = (M + C + 180 + 102.9372) % 360
+    transit = 2451545.0 + mean_solar_time + 0.0053 * math.sin(math.radians(M)) - 0.0069 * math.sin(math.radians(2 * ecliptic_longitude))
+    sin_declination = math.sin(math.radians(ecliptic_longitude)) * math.sin(math.radians(23.4397))
+    cos_declination = math.cos(math.asin(sin_declination))
+    cos_hour_angle = ((math.sin(math.radians(-0.833)) - math.sin(math.radians(latitude)) * sin_declination) /
+                      (math.cos(math.radians(latitude)) * cos_declination))
+    if not -1 <= cos_hour_angle <= 1:
+        return None
+    hour_angle = math.degrees(math.acos(cos_hour_angle))
+    midnight = jd - 0.5
+    return (round((transit - hour_angle / 360 - midnight) * 1440),
+            round((transit + hour_angle / 360 - midnight) * 1440))
+
+
+class SunTable:
+    # Sunrise and sunset for every day of the year at one location, in minutes after UTC midnight
+    def __init__(self, latitude, longitude, year=None):
+        year = year or date.today().year
+        self.sunrise = array('h')
+        self.sunset = array('h')
+        for day_of_year in range(366):
+            day = date.fromordinal(date(year, 1, 1).toordinal() + day_of_year)
+            times = sunrise_sunset_utc(latitude, longitude, day) or (POLAR, POLAR)
+            self.sunrise.append(times[0])
+            self.sunset.append(times[1])
+
+    def get(self, day):
+        # (sunrise, sunset) as local datetimes, None during polar day or night
+        index = day.timetuple().tm_yday - 1
+        if self.sunrise[index] == POLAR:
+            return None
+        midnight = calendar.timegm(day.timetuple())
+        return (datetime.fromtimestamp(midnight + self.sunrise[index] * 60),
+                datetime.fromtimestamp(midnight + self.sunset[index] * 60))
+
+
+if __name__ == "__main__":
+    table = SunTable(50.24, 24.14)
+    print(table.get(date.today()))
@@ -0,0 +1,16 @@
+// Bulk write for the Jetson Nano software SPI, one call from Python per buffer
+// instead of one per byte. Resolves SYSFS_software_spi_transfer from
+// sysfs_software_spi.so, which epdconfig loads globally before this library.
+//
+// gcc -O2 -shared -fPIC -o sysfs_software_spi_bulk.so sysfs_software_spi_bulk.c
+
+#include <stddef.h>
+#include <stdint.h>
+
+uint8_t SYSFS_software_spi_transfer(uint8_t value);
+
+void SYSFS_software_spi_writebytes(const uint8_t *data, size_t len)
+{
+    for (size_t i = 0; i < len; i++)
+        SYSFS_software_spi_transfer(data[i]);
+}
@@ -1,7 +1,15 @@
+import os
 import time
 import json
-from urllib.request import urlopen
-from datetime import datetime, timedelta
+import hashlib
+import threading
+from collections import Counter
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+from datetime import date, datetime, timedelta
+from sun_lib import SunTable
 
 WEATHER_KEY = ''  # OpenWeatherMap API key
 LOCATION_STRING = 'lat=50.24&lon=24.14' #'Velyki Mosty, UA'  # Location parameter, see below for details [50.2402, 24.1385]
@@ -10,12 +18,27 @@ LOCATION_STRING = 'lat=50.24&lon=24.14' #'Velyki Mosty, UA'  # Location paramete
 # - By city id: simply lookup your desired city in https://openweathermap.org/ and the city id will show up in URL field. e.g. 'id=2172797'
 # - By geographic coordinates: by latitude and longitude. e.g. 'lat=35&lon=139'
 # - By ZIP code: by zip/post code (if country is not specified, will search the USA). e.g. 'zip=94040,us'
+LATITUDE = 50.24  # used for local sunrise/sunset, keep in sync with LOCATION_STRING
+LONGITUDE = 24.14
 UNIT_SUITE = 'metric'  # Unit of measurements, can be 'metric' or 'imperial'
 TIME_UNIT = 24
 # time_shift_s = 7200
 time_shift_s = time.localtime().tm_gmtoff
 WEATHER_URL = 'http://api.openweathermap.org/data/2.5/weather?APPID=' + WEATHER_KEY + '&units=' + UNIT_SUITE + '&' + LOCATION_STRING + '&lang=ua'
 FORECAST_URL = 'http://api.openweathermap.org/data/2.5/forecast?APPID=' + WEATHER_KEY + '&units=' + UNIT_SUITE + '&' + LOCATION_STRING + '&lang=ua'
+REQUEST_TIMEOUT = 10  # seconds per request attempt
+REQUEST_RETRIES = 3
+REQUEST_BACKOFF = 2  # seconds before the first retry, doubled after each one
+# seconds a cached response is served without asking the server again
+CACHE_TTL = {
+    WEATHER_URL: 600,
+    FORECAST_URL: 1800
+}
+# seconds after which a cached response is too old to show and is fetched again before use
+CACHE_MAX_STALE = {
+    WEATHER_URL: 3 * 3600,
+    FORECAST_URL: 6 * 3600
+}
 
 CLOUD_SUN_SIZE = {
     800: (0, 2),
@@ -71,6 +94,24 @@ RAIN_SNOW_SIZE = {
     232: (0, 0, 3, 27, True)
 }
 
+JSON_DECODER = json.JSONDecoder()
+WHITESPACE = ' \t\n\r'
+
+WEATHER_ID_MIN = 200
+WEATHER_ID_MAX = 804
+
+
+def compile_table(sizes):
+    # direct index lookup: table[weather_id - WEATHER_ID_MIN] or None
+    table = [None] * (WEATHER_ID_MAX - WEATHER_ID_MIN + 1)
+    for weather_id, size in sizes.items():
+        table[weather_id - WEATHER_ID_MIN] = size
+    return tuple(table)
+
+
+RAIN_SNOW_TABLE = compile_table(RAIN_SNOW_SIZE)
+CLOUD_SUN_TABLE = compile_table(CLOUD_SUN_SIZE)
+
 
 def utc_to_timezone(epoch):
     # TODO: check
@@ -78,13 +119,122 @@ def utc_to_timezone(epoch):
     return datetime.fromtimestamp(epoch)
 
 
+def fetch_text(url, timeout=REQUEST_TIMEOUT, retries=REQUEST_RETRIES, backoff=REQUEST_BACKOFF):
+    return request_text(url, timeout, retries, backoff)[0]
+
+
+def request_text(request, timeout=REQUEST_TIMEOUT, retries=REQUEST_RETRIES, backoff=REQUEST_BACKOFF):
+    # (body, response headers), body is None for 304 Not Modified
+    for attempt in range(retries):
+        try:
+            with urlopen(request, timeout=timeout) as response:
+                return response.read().decode('utf-8'), response.headers
+        except HTTPError as e:
+            if e.code == 304:
+                return None, e.headers
+            if attempt == retries - 1:
+                raise
+            print(f'Weather request failed ({e}), retry in {backoff * 2 ** attempt} s')
+            time.sleep(backoff * 2 ** attempt)
+        except (URLError, OSError, ValueError) as e:
+            if attempt == retries - 1:
+                raise
+            print(f'Weather request failed ({e}), retry in {backoff * 2 ** attempt} s')
+            time.sleep(backoff * 2 ** attempt)
+
+
+class ResponseCache:
+    # Response bodies stored on disk, expired entries are returned at once and revalidated in background
+    def __init__(self, path, ttl=CACHE_TTL, max_stale=CACHE_MAX_STALE):
+        self.path = path
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.stats = Counter()
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.pending = {}
+        os.makedirs(path, exist_ok=True)
+
+    def entry_path(self, url):
+        # the url contains the API key, so it is not used as a file name
+        return os.path.join(self.path, hashlib.sha1(url.encode()).hexdigest() + '.json')
+
+    def load(self, url):
+        try:
+            with open(self.entry_path(url)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def store(self, url, entry):
+        tmp_path = self.entry_path(url) + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, self.entry_path(url))
+
+    def get(self, url, on_refresh=None):
+        entry = self.load(url)
+        if entry is None:
+            self.stats['miss'] += 1
+            return self.refresh(url, None)['body']
+        age = time.time() - entry['time']
+        if age < self.ttl.get(url, 0):
+            self.stats['hit'] += 1
+        elif age >= self.max_stale.get(url, float('inf')):
+            # too old to publish, wait for the server like on a miss and fail the update without it
+            self.stats['expired'] += 1
+            return self.refresh_async(url, entry).result()['body']
+        else:
+            self.stats['stale'] += 1
+            self.refresh_async(url, entry, on_refresh)
+        return entry['body']
+
+    def refresh(self, url, entry):
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        body, response_headers = request_text(Request(url, headers=headers))
+        if body is None:
+            self.stats['not_modified'] += 1
+            body = entry['body']
+        entry = {
+            'time': time.time(),
+            'etag': response_headers.get('ETag'),
+            'last_modified': response_headers.get('Last-Modified'),
+            'body': body
+        }
+        self.store(url, entry)
+        return entry
+
+    def refresh_async(self, url, entry, on_refresh=None):
+        if url in self.pending:
+            return self.pending[url]
+        future = self.executor.submit(self.refresh, url, entry)
+        self.pending[url] = future
+
+        def done(future):
+            del self.pending[url]
+            if future.exception():
+                self.stats['error'] += 1
+                print(f'Weather cache refresh failed: {future.exception()}')
+            elif on_refresh and future.result()['body'] is not entry['body']:
+                # 304 Not Modified keeps the old body object, nothing new to publish
+                on_refresh()
+        future.add_done_callback(done)
+        return future
+
+
 class Forecast:
+    __slots__ = ('dt', 'temperature', 'weather_ids', 'weather_icons', 'snow_size', 'snow_mask',
+                 'rain_size', 'rain_mask', 'thunder', 'cloud_size', 'sun_size')
+
     def __init__(self, data):
         self.dt = utc_to_timezone(data['dt'])
         self.temperature = data['main']['temp']
         weather_list = data['weather']
-        self.weather_ids = {w['id'] for w in weather_list}
-        self.weather_icons = {w['icon'] for w in weather_list}
+        self.weather_ids = tuple(w['id'] for w in weather_list)
+        self.weather_icons = tuple(w['icon'] for w in weather_list)
         self.snow_size = 0
         self.snow_mask = 0
         self.rain_size = 0
@@ -92,47 +242,140 @@ class Forecast:
         self.thunder = False
         self.cloud_size = 0
         self.sun_size = 0
-        rain_snow = self.weather_ids & set(RAIN_SNOW_SIZE.keys())
+        rain_snow = cloud_sun = None
+        for weather_id in self.weather_ids:
+            index = weather_id - WEATHER_ID_MIN
+            if 0 <= index < len(RAIN_SNOW_TABLE):
+                rain_snow = rain_snow or RAIN_SNOW_TABLE[index]
+                cloud_sun = cloud_sun or CLOUD_SUN_TABLE[index]
         if rain_snow:
-            weather_id = next(iter(rain_snow))
-            self.snow_size, self.snow_mask, self.rain_size, self.rain_mask, self.thunder = RAIN_SNOW_SIZE[weather_id]
+            self.snow_size, self.snow_mask, self.rain_size, self.rain_mask, self.thunder = rain_snow
             self.cloud_size = 5
-        cloud_sun = self.weather_ids & set(CLOUD_SUN_SIZE.keys())
         if cloud_sun:
-            weather_id = next(iter(cloud_sun))
-            self.cloud_size, self.sun_size = CLOUD_SUN_SIZE[weather_id]
+            self.cloud_size, self.sun_size = cloud_sun
+
+
+class ForecastList(Sequence):
+    # Forecast entries of the "list" array in a forecast response, decoded on first access
+    # so a render that needs only the first few entries never parses the rest
+    def __init__(self, text):
+        self.text = text
+        self.items = []
+        self.pos = self.find_list()
+
+    def skip(self, chars):
+        while self.pos < len(self.text) and self.text[self.pos] in chars:
+            self.pos += 1
+
+    def find_list(self):
+        # walk the top level object until the value of "list"
+        self.pos = 0
+        self.skip(WHITESPACE + '{')
+        while self.pos < len(self.text) and self.text[self.pos] != '}':
+            key, self.pos = JSON_DECODER.raw_decode(self.text, self.pos)
+            self.skip(WHITESPACE + ':')
+            if key == 'list':
+                self.skip(WHITESPACE + '[')
+                return self.pos
+            _, self.pos = JSON_DECODER.raw_decode(self.text, self.pos)
+            self.skip(WHITESPACE + ',')
+        raise ValueError('No forecast list in the response')
+
+    def decode(self, count=None):
+        while self.pos is not None and (count is None or len(self.items) < count):
+            self.skip(WHITESPACE)
+            if self.text[self.pos] == ']':
+                self.pos = None
+                self.text = None
+                break
+            data, self.pos = JSON_DECODER.raw_decode(self.text, self.pos)
+            self.items.append(Forecast(data))
+            self.skip(WHITESPACE + ',')
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            stop = index.stop
+            self.decode(stop if stop is not None and stop >= 0 and (index.start or 0) >= 0 else None)
+        else:
+            self.decode(index + 1 if index >= 0 else None)
+        return self.items[index]
+
+    def __len__(self):
+        self.decode()
+        return len(self.items)
 
 
 class Weather:
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, cache_dir=None, current=True, forecast_num=None):
         self.debug = debug
+        # entries decoded before an update is published, None for all of them
+        self.forecast_num = forecast_num
+        # without the current weather request sunrise/sunset come from the local table only
+        self.current = current
+        self.sun_table = SunTable(LATITUDE, LONGITUDE)
+        self.cache = ResponseCache(os.path.join(cache_dir, 'weather')) if cache_dir else None
+        # readers take the lock to see all fields from the same update
+        self.lock = threading.Lock()
+        self.version = 0
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
 
     def update(self):
+        urls = [FORECAST_URL, WEATHER_URL] if self.current else [FORECAST_URL]
         if self.debug:
-            with open('./weather_query.json') as f:
-                weather_query = json.load(f)
-            with open('./forecast_query.json') as f:
-                forecast_query = json.load(f)
+            texts = []
+            for path in ['./forecast_query.json', './weather_query.json'][:len(urls)]:
+                with open(path) as f:
+                    texts.append(f.read())
         else:
-            with urlopen(WEATHER_URL) as weather_response:
-                weather_query = json.loads(weather_response.read())
-                # with open('weather_query.json', 'w', encoding='utf-8') as f:
-                #     json.dump(weather_query, f, ensure_ascii=False, indent=4)
-            with urlopen(FORECAST_URL) as forecast_response:
-                forecast_query = json.loads(forecast_response.read())
-                # with open('forecast_query.json', 'w', encoding='utf-8') as f:
-                #     json.dump(forecast_query, f, ensure_ascii=False, indent=4)
-        self.sunrise_time = utc_to_timezone(weather_query['sys']['sunrise'])
-        self.sunset_time = utc_to_timezone(weather_query['sys']['sunset'])
-        self.dt = utc_to_timezone(weather_query['dt'])
-        self.humidity_now = weather_query['main']['humidity']
-        self.pressure_now = int(weather_query['main']['pressure'] * 0.75006157584566)
-        self.forecast_list = [Forecast(f) for f in forecast_query['list']]
+            with ThreadPoolExecutor(max_workers=len(urls)) as pool:
+                if self.cache:
+                    # stale data is published now and again once it is revalidated
+                    futures = [pool.submit(self.cache.get, url, self.update_async) for url in urls]
+                else:
+                    futures = [pool.submit(fetch_text, url) for url in urls]
+                texts = [future.result() for future in futures]
+        forecast_list = ForecastList(texts[0])
+        # a malformed entry fails this update here and keeps the published data, not the render
+        forecast_list[:self.forecast_num]
+        dt = humidity_now = pressure_now = None
+        sun_times = self.sun_table.get(date.today())
+        if self.current:
+            weather_query = json.loads(texts[1])
+            if sun_times is None:
+                sun_times = utc_to_timezone(weather_query['sys']['sunrise']), utc_to_timezone(weather_query['sys']['sunset'])
+            dt = utc_to_timezone(weather_query['dt'])
+            humidity_now = weather_query['main']['humidity']
+            pressure_now = int(weather_query['main']['pressure'] * 0.75006157584566)
+        if sun_times is None:
+            # polar day or night and nothing better known
+            today = datetime.combine(date.today(), datetime.min.time())
+            sun_times = today, today + timedelta(hours=23, minutes=59)
+        sunrise_time, sunset_time = sun_times
+        with self.lock:
+            self.sunrise_time = sunrise_time
+            self.sunset_time = sunset_time
+            self.dt = dt
+            self.humidity_now = humidity_now
+            self.pressure_now = pressure_now
+            self.forecast_list = forecast_list
+            self.version += 1
         # print(self.dt, self.sunrise_time, self.sunset_time)
 
+    def update_async(self):
+        # Queue update() on the background worker, the new data shows up as a new version
+        self.future = self.executor.submit(self.update)
+        self.future.add_done_callback(self.update_done)
+        return self.future
+
+    def update_done(self, future):
+        if future.exception():
+            print(f'Weather update failed: {future.exception()}')
+
 
 if __name__ == "__main__":
     w = Weather(True)
     w.update()
     print(w.sunrise_time, w.sunset_time)
-    print(json.dumps(forecast_query, indent=4))
+    for f in w.forecast_list:
+        print(f.dt, f.temperature, f.weather_ids)